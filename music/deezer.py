@@ -1,10 +1,14 @@
 import os
+import json
 import httpx
 import hashlib
 import asyncio
+import logging
+import traceback
 from bot import Bot
 from time import time
 from math import ceil
+from concurrent.futures import Executor
 from random import randint
 from typing import Optional
 from pyrogram import filters
@@ -14,19 +18,83 @@ from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
-from cryptography.hazmat.backends import default_backend
 from .util import (
     download_file,
     download_progress,
     parse_data,
-    tag_file,
+    TagBatch,
+    get_tag_executor,
+    close_tag_executors,
+    tag_executor_settings,
+    gather_limited,
+    Track,
+    Album,
+    close_clients,
+    close_stale_clients,
+    configure_clients,
+    client_settings,
+    is_downloading,
+    remove_partial,
+    StreamTransform,
+    TTLCache,
+    SearchCache,
     error_handler,
     error_handler_decorator,
 )
-from cryptography.hazmat.decrepit.ciphers import algorithms
-from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from .stripes import (
+    BLOCK_SIZE,
+    close_decrypt_executors,
+    decrypt_stripes,
+    get_decrypt_executor,
+)
+
+from sqlalchemy import Text, delete, select
+from sqlalchemy.orm import Session, Mapped, mapped_column
+
+from bot.settings import Settings, DataBase
+
+
+class DeezerGenreDatabase(DataBase):
+    __tablename__ = "deezer_genres"
+
+    album_id: Mapped[str] = mapped_column(Text(), primary_key=True)
+    genre: Mapped[str] = mapped_column(Text())
+
+
+class DeezerSessionDatabase(DataBase):
+    __tablename__ = "deezer_sessions"
+
+    # sha256 of the ARL the session belongs to
+    arl: Mapped[str] = mapped_column(Text(), primary_key=True)
+    session: Mapped[str] = mapped_column(Text())
+
+
+# The licence token is renewed this many seconds before it is an hour old
+LICENSE_TTL = 3600
+SESSION_RENEW_MARGIN = 300
+
+# Session state saved to the data store so a restart needs no login
+SESSION_KEYS = (
+    "api_token",
+    "license_token",
+    "renew_timestamp",
+    "country",
+    "language",
+    "available_formats",
+    "streaming_group",
+)
 
-from bot.settings import Settings
+# Seconds a gw-light response stays cached, other methods (user data,
+# tokens, ARLs) always reach Deezer
+API_CACHE_TTLS = {
+    "deezer.pageTrack": 600,
+    "deezer.pageAlbum": 1800,
+    "deezer.pagePlaylist": 600,
+    "song.getLyrics": 3600,
+    "artist.getData": 3600,
+    "album.getDiscography": 1800,
+    "search.music": 300,
+}
 
 
 # APIError and DeezerAPI classes from https://github.com/uhwot/orpheusdl-deezer
@@ -48,6 +116,7 @@ class DeezerAPI:
         client_secret: str,
         bf_secret: str,
         proxy: Optional[str] = None,
+        cache_size: int = 128,
     ):
         self.gw_light_url = "https://www.deezer.com/ajax/gw-light.php"
         self.api_token = ""
@@ -55,6 +124,14 @@ class DeezerAPI:
         self.client_secret = client_secret
 
         self.bf_secret = bf_secret.encode("ascii")
+        self.cache = TTLCache(cache_size)
+        self.genres = TTLCache(1024, ttl=24 * 3600)
+        self.renew_timestamp = 0
+        self.streaming_group = None
+        self.arl = None
+        self.config = None
+        self._renewal: asyncio.Future | None = None
+        self._keeper: asyncio.Task | None = None
 
         self.session = httpx.AsyncClient(proxy=proxy)
         self.session.headers.update(
@@ -74,6 +151,16 @@ class DeezerAPI:
         )
 
     async def _api_call(self, method: str, payload: Optional[dict] = None):
+        ttl = API_CACHE_TTLS.get(method)
+        if ttl is None:
+            return await self._request(method, payload)
+
+        key = (method, json.dumps(payload or {}, sort_keys=True))
+        return await self.cache.get_or_fetch(
+            key, lambda: self._request(method, payload), ttl
+        )
+
+    async def _request(self, method: str, payload: Optional[dict] = None):
         api_token = (
             self.api_token
             if method not in ("deezer.getUserData", "user.getArl")
@@ -105,6 +192,9 @@ class DeezerAPI:
                 "license_token"
             ]
             self.renew_timestamp = ceil(time())
+            self.streaming_group = resp["results"]["USER"]["OPTIONS"].get(
+                "streaming_group"
+            )
             self.language = resp["results"]["USER"]["SETTING"]["global"][
                 "language"
             ]
@@ -152,6 +242,7 @@ class DeezerAPI:
         return arl, self.login_via_arl(arl)
 
     async def login_via_arl(self, arl: str):
+        self.arl = arl
         self.session.cookies.set("arl", arl, domain=".deezer.com")
         user_data = await self._api_call("deezer.getUserData")
 
@@ -159,6 +250,7 @@ class DeezerAPI:
             self.session.cookies.clear()
             raise Exception("Invalid arl")
 
+        await self.session_changed(user_data)
         return user_data
 
     async def get_track(self, id: str | int):
@@ -268,25 +360,101 @@ class DeezerAPI:
         resp = await self._api_call("album.getDiscography", payload)
         return [a["ALB_ID"] for a in resp["data"]]
 
-    async def get_track_url(
-        self,
-        id: str | int,
-        track_token: str,
-        track_token_expiry: str,
-        format: str,
-    ):
-        # renews license token
-        if time() - self.renew_timestamp >= 3600:
-            await self._api_call("deezer.getUserData")
+    async def session_changed(self, user_data: dict):
+        pass
 
-        # renews track token
-        if time() - track_token_expiry >= 0:
-            track_token = (
-                await self._api_call(
-                    "song.getData",
-                    {"sng_id": id, "array_default": ["TRACK_TOKEN"]},
-                )
-            )["TRACK_TOKEN"]
+    def dump_session(self) -> dict:
+        return dict(
+            {key: getattr(self, key, None) for key in SESSION_KEYS},
+            cookies=[
+                [cookie.name, cookie.value, cookie.domain]
+                for cookie in self.session.cookies.jar
+                # The ARL stays in deezer_arl only
+                if cookie.name != "arl"
+            ],
+        )
+
+    def load_session(self, data: dict):
+        for key in SESSION_KEYS:
+            setattr(self, key, data[key])
+
+        for name, value, domain in data["cookies"]:
+            self.session.cookies.set(name, value, domain=domain)
+
+    async def validate_session(self):
+        # A stored session may have been revoked, log in again if so
+        user_data = await self.renew_session()
+        if not user_data["USER"]["USER_ID"] and self.arl:
+            await self.login_via_arl(self.arl)
+
+    async def renew_session(self):
+        # Concurrent callers share one deezer.getUserData request
+        if self._renewal is None or self._renewal.done():
+            self._renewal = asyncio.ensure_future(self._renew_session())
+
+        return await asyncio.shield(self._renewal)
+
+    async def _renew_session(self) -> dict:
+        user_data = await self._api_call("deezer.getUserData")
+        await self.session_changed(user_data)
+
+        return user_data
+
+    async def renew_license(self):
+        # Normally the session keeper got here first
+        if time() - self.renew_timestamp >= LICENSE_TTL:
+            await self.renew_session()
+
+    async def _keep_session(self, validate: bool = False):
+        if validate:
+            try:
+                await self.validate_session()
+            except Exception as e:
+                logging.debug("The stored Deezer session is invalid: %s", e)
+
+        while True:
+            delay = (
+                self.renew_timestamp
+                + LICENSE_TTL
+                - SESSION_RENEW_MARGIN
+                - time()
+            )
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self.renew_session()
+            except Exception as e:
+                logging.debug("Renewing the Deezer session failed: %s", e)
+                await asyncio.sleep(60)
+
+    def start_session_keeper(self, validate: bool = False):
+        if self._keeper is None or self._keeper.done():
+            self._keeper = asyncio.create_task(self._keep_session(validate))
+
+    async def close(self):
+        if self._keeper is not None:
+            self._keeper.cancel()
+            self._keeper = None
+
+        await self.session.aclose()
+
+    async def get_track_tokens(self, ids: list[str | int]) -> dict:
+        resp = await self._api_call(
+            "song.getListData", {"sng_ids": [str(id) for id in ids]}
+        )
+        return {
+            str(song["SNG_ID"]): (
+                song["TRACK_TOKEN"],
+                int(song["TRACK_TOKEN_EXPIRE"]),
+            )
+            for song in resp["data"]
+            if song.get("TRACK_TOKEN")
+        }
+
+    async def get_track_urls(
+        self, track_tokens: list[str], format: str
+    ) -> list[list[str] | Exception]:
+        # Every track gets all of its CDN sources, download_file picks one
+        await self.renew_license()
 
         json = {
             "license_token": self.license_token,
@@ -296,14 +464,58 @@ class DeezerAPI:
                     "formats": [{"cipher": "BF_CBC_STRIPE", "format": format}],
                 }
             ],
-            "track_tokens": [track_token],
+            "track_tokens": track_tokens,
         }
         resp = (
             await self.session.post(
                 "https://media.deezer.com/v1/get_url", json=json
             )
         ).json()
-        return resp["data"][0]["media"][0]["sources"][0]["url"]
+        if "data" not in resp:
+            error = (resp.get("errors") or [{}])[0]
+            raise Exception(error.get("message", "Failed to get the URLs"))
+
+        urls = []
+        for data in resp["data"]:
+            if data.get("media") and data["media"][0]["sources"]:
+                urls.append(
+                    [source["url"] for source in data["media"][0]["sources"]]
+                )
+                continue
+
+            error = (data.get("errors") or [{}])[0]
+            urls.append(
+                Exception(
+                    "{} ({})".format(
+                        error.get("message", f"{format} is not available"),
+                        error.get("code", "no source"),
+                    )
+                )
+            )
+
+        return urls
+
+    async def get_track_url(
+        self,
+        id: str | int,
+        track_token: str,
+        track_token_expiry: str,
+        format: str,
+    ):
+        # renews track token
+        if time() - int(track_token_expiry) >= 0:
+            track_token = (
+                await self._api_call(
+                    "song.getData",
+                    {"sng_id": id, "array_default": ["TRACK_TOKEN"]},
+                )
+            )["TRACK_TOKEN"]
+
+        url = (await self.get_track_urls([track_token], format))[0]
+        if isinstance(url, Exception):
+            raise url
+
+        return url
 
     def _get_blowfish_key(self, track_id: str | int):
         # yeah, you use the bytes of the hex digest of the hash. bruh moment
@@ -318,6 +530,30 @@ class DeezerAPI:
         return key
 
 
+MEDIA_BATCH_SIZE = 100
+# Track tokens this close to TRACK_TOKEN_EXPIRE are renewed first
+TRACK_TOKEN_MARGIN = 60
+
+
+class StripeDecryptor(StreamTransform):
+    # BF_CBC_STRIPE: every third 2048 byte block is encrypted
+    block_size = BLOCK_SIZE
+
+    def __init__(self, key: bytes, executor: Executor = None):
+        self.key = key
+        self.executor = executor
+
+    async def process(self, index: int, data: bytes) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor or get_decrypt_executor(),
+            decrypt_stripes,
+            self.key,
+            index,
+            data,
+            self.block_size,
+        )
+
+
 class Deezer(DeezerAPI):
     def __init__(
         self,
@@ -325,26 +561,109 @@ class Deezer(DeezerAPI):
         client_secret: str,
         bf_secret: str,
         proxy: str = None,
+        cache_size: int = 128,
     ):
-        super().__init__(client_id, client_secret, bf_secret, proxy)
+        super().__init__(
+            client_id, client_secret, bf_secret, proxy, cache_size
+        )
+        self.searches = SearchCache(self.search_track)
 
     @classmethod
     async def create(
         cls, client_id: str, client_secret: str, bf_secret: str, arl: str
     ):
-        instance = cls(client_id, client_secret, bf_secret, Settings.PROXY)
+        instance = cls(
+            client_id,
+            client_secret,
+            bf_secret,
+            Settings.PROXY,
+            int(Settings.getdata("deezer_cache_size", 128)),
+        )
+        session = await asyncio.get_running_loop().run_in_executor(
+            None, cls._load_session, cls._fingerprint(arl)
+        )
+        if session is not None:
+            try:
+                instance.load_session(json.loads(session))
+            except (KeyError, TypeError, ValueError):
+                pass
+            else:
+                # Usable at once, checked against Deezer in the background
+                instance.arl = arl
+                instance.session.cookies.set("arl", arl, domain=".deezer.com")
+                instance.start_session_keeper(validate=True)
+                return instance
+
         await instance.login_via_arl(arl)
+        instance.start_session_keeper()
         return instance
 
-    def _track(self, data: dict[str, str]):
-        result = dict(
+    @staticmethod
+    def _fingerprint(arl: str) -> str:
+        return hashlib.sha256(arl.encode()).hexdigest()
+
+    @staticmethod
+    def _load_session(fingerprint: str) -> str | None:
+        with Session(Settings.engine) as session:
+            return session.execute(
+                select(DeezerSessionDatabase.session).where(
+                    DeezerSessionDatabase.arl == fingerprint
+                )
+            ).scalar()
+
+    @staticmethod
+    def _save_session(fingerprint: str, data: str):
+        # Sessions of a previous ARL are of no use anymore
+        with Session(Settings.engine) as session:
+            session.execute(
+                delete(DeezerSessionDatabase).where(
+                    DeezerSessionDatabase.arl != fingerprint
+                )
+            )
+            session.merge(DeezerSessionDatabase(arl=fingerprint, session=data))
+            session.commit()
+
+    async def session_changed(self, user_data: dict):
+        # Kept in its own table, the settings store would notify every
+        # plugin on each hourly renewal
+        if not user_data["USER"]["USER_ID"] or not self.arl:
+            return
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                self._save_session,
+                self._fingerprint(self.arl),
+                json.dumps(self.dump_session()),
+            )
+        except Exception:
+            # The next start logs in again, nothing more is lost
+            logging.debug(traceback.format_exc())
+
+    def _track(self, data: dict[str, str], album: Album = None):
+        sizes = {
+            format: int(data[f"FILESIZE_{format}"] or 0)
+            for format in ("FLAC", "MP3_320", "MP3_128")
+            if f"FILESIZE_{format}" in data
+        }
+        quality = next(
+            (format for format, size in sizes.items() if size),
+            next(iter(sizes), ""),
+        )
+
+        return Track(
             id=data["SNG_ID"],
             title=data["SNG_TITLE"],
             version=data.get("VERSION"),
-            artist={"name": data["ART_NAME"]},
-            artists=[
-                {"name": artist["ART_NAME"]} for artist in data["ARTISTS"]
-            ],
+            artist=", ".join(artist["ART_NAME"] for artist in data["ARTISTS"]),
+            duration=data["DURATION"],
+            track_number=data["TRACK_NUMBER"],
+            disc_number=data["DISK_NUMBER"],
+            composer=", ".join(
+                (data["SNG_CONTRIBUTORS"] or {}).get("composer", [])
+            ),
+            copyright=data.get("COPYRIGHT"),
+            isrc=data.get("ISRC"),
             preview=next(
                 (
                     item["HREF"]
@@ -353,34 +672,15 @@ class Deezer(DeezerAPI):
                 ),
                 None,
             ),
-            time=data["SNG_ID"],
-            duration=data["DURATION"],
-            track_token=data["TRACK_TOKEN"],
-            track_token_expire=data["TRACK_TOKEN_EXPIRE"],
+            format=quality.split("_")[0].lower(),
+            quality=quality,
+            file_size=sizes.get(quality) or None,
             album_id=data["ALB_ID"],
-            album_picture=data["ALB_PICTURE"],
-            disc_number=data["DISK_NUMBER"],
-            track_number=data["TRACK_NUMBER"],
-            composer={
-                "name": ", ".join(
-                    (data["SNG_CONTRIBUTORS"] or {}).get("composer", [])
-                )
-            },
-            copyright=data.get("COPYRIGHT"),
+            album=album,
+            source="Deezer",
+            raw=data,
         )
 
-        result["format"] = ""
-        for _format in ["FLAC", "MP3_320", "MP3_128"]:
-            if f"FILESIZE_{_format}" in data:
-                format = data[f"FILESIZE_{_format}"]
-                if format != "0":
-                    result[_format.lower()] = data[f"FILESIZE_{_format}"]
-
-                if not result["format"]:
-                    result["format"] = _format.lower()
-
-        return result
-
     def _cover(self, hash: str, resolution: int = 3000):
         resolution = 3000 if resolution > 3000 else resolution
         compression = 50
@@ -401,7 +701,7 @@ class Deezer(DeezerAPI):
     async def get_track_cover(
         self,
         id: Optional[str | int] = None,
-        track: Optional[dict[str, str]] = None,
+        track: Optional[Track] = None,
         resolution: int = 3000,
     ):
         if not id and not track:
@@ -410,7 +710,7 @@ class Deezer(DeezerAPI):
         if id:
             cover_hash = await super().get_track_cover(id)
         else:
-            cover_hash = track["album_picture"]
+            cover_hash = track.raw["ALB_PICTURE"]
 
         return self._cover(cover_hash, resolution=resolution)
 
@@ -430,34 +730,77 @@ class Deezer(DeezerAPI):
     async def get_album(self, id: str | int):
         album = await super().get_album(id)
         data = album["DATA"]
-        return dict(
+        result = Album(
             id=data["ALB_ID"],
             title=data["ALB_TITLE"],
-            artist={"name": data["ART_NAME"]},
-            artists=[
-                {"name": artist["ART_NAME"]} for artist in data["ARTISTS"]
-            ],
-            genre={"name": await self.get_album_genre(data["ALB_ID"])},
+            artist=", ".join(artist["ART_NAME"] for artist in data["ARTISTS"]),
+            main_artist=data["ART_NAME"],
             tracks_count=data["NUMBER_TRACK"],
-            songs=(
-                [self._track(track) for track in album["SONGS"]["data"]]
-                if "SONGS" in album
-                else []
-            ),
-            media_count="",
-            release_date=data.get("ORIGINAL_RELEASE_DATE", ""),
+            date=data.get("ORIGINAL_RELEASE_DATE", ""),
             duration=data["DURATION"],
             cover=self._cover(data["ALB_PICTURE"]),
+            source="Deezer",
+            raw=data,
         )
+        result.tracks = [
+            self._track(track, result)
+            for track in album.get("SONGS", {}).get("data", [])
+        ]
+
+        return result
+
+    @staticmethod
+    def _load_genre(id: str) -> str | None:
+        with Session(Settings.engine) as session:
+            return session.execute(
+                select(DeezerGenreDatabase.genre).where(
+                    DeezerGenreDatabase.album_id == id
+                )
+            ).scalar()
+
+    @staticmethod
+    def _save_genre(id: str, genre: str):
+        with Session(Settings.engine) as session:
+            session.merge(DeezerGenreDatabase(album_id=id, genre=genre))
+            session.commit()
+
+    async def _fetch_album_genre(self, id: str) -> str:
+        loop = asyncio.get_running_loop()
+        genre = await loop.run_in_executor(None, self._load_genre, id)
+        if genre is not None:
+            return genre
 
-    async def get_album_genre(self, id: str | int):
         resp = (
             await self.session.get(f"https://api.deezer.com/album/{id}")
         ).json()
-        if not resp["genres"]["data"]:
-            return ""
+        if "genres" not in resp:
+            # Quota errors and the like are temporary, only a real album
+            # payload is stored
+            error = resp.get("error") or {}
+            raise Exception(error.get("message", "Failed to get the genre"))
+
+        genres = resp["genres"].get("data")
+        genre = genres[0]["name"] if genres else ""
+        await loop.run_in_executor(None, self._save_genre, id, genre)
+
+        return genre
+
+    async def get_album_genre(self, id: str | int) -> str:
+        # Only needed for tags, so it is resolved on demand and kept in
+        # the database since an album's genre doesn't change
+        id = str(id)
+        return await self.genres.get_or_fetch(
+            id, lambda: self._fetch_album_genre(id)
+        )
+
+    async def resolve_genre(self, album: Album) -> str:
+        if not album.genre:
+            try:
+                album.genre = await self.get_album_genre(album.id)
+            except Exception:
+                album.genre = ""
 
-        return resp["genres"]["data"][0]["name"]
+        return album.genre
 
     async def get_album_songs(
         self, id: str | int, start: int = 0, limit: int = 500
@@ -472,33 +815,89 @@ class Deezer(DeezerAPI):
             )["data"]
         ]
 
-    async def get_file_url(self, track: dict[str, str]):
+    async def get_file_url(self, track: Track):
         return await super().get_track_url(
-            track["id"],
-            track["track_token"],
-            track["track_token_expire"],
-            track["format"].upper(),
+            track.id,
+            track.raw["TRACK_TOKEN"],
+            track.raw["TRACK_TOKEN_EXPIRE"],
+            track.quality,
         )
 
-    async def decrypt_chunk(self, index: int, chunk: str, id: str | int):
-        bf_key = self._get_blowfish_key(id)
-        cipher = Cipher(
-            algorithms.Blowfish(bf_key),
-            modes.CBC(b"\x00\x01\x02\x03\x04\x05\x06\x07"),
-            backend=default_backend(),
-        )
-        if index % 3 == 0 and len(chunk) == 2048:
-            decryptor = cipher.decryptor()
-            chunk = decryptor.update(chunk) + decryptor.finalize()
+    async def get_file_urls(
+        self, tracks: list[Track]
+    ) -> dict[str, list[str] | Exception]:
+        # Expired tokens are renewed in one call, then every format is
+        # resolved MEDIA_BATCH_SIZE tokens at a time
+        expired = [
+            track
+            for track in tracks
+            if time() + TRACK_TOKEN_MARGIN
+            >= int(track.raw.get("TRACK_TOKEN_EXPIRE") or 0)
+        ]
+        if expired:
+            tokens = await self.get_track_tokens(
+                [track.id for track in expired]
+            )
+            for track in expired:
+                if track.id in tokens:
+                    token, expire = tokens[track.id]
+                    # raw is shared with DeezerAPI.cache, give the track
+                    # its own copy
+                    track.raw = dict(
+                        track.raw,
+                        TRACK_TOKEN=token,
+                        TRACK_TOKEN_EXPIRE=expire,
+                    )
+
+        formats: dict[str, list[Track]] = {}
+        for track in tracks:
+            formats.setdefault(track.quality, []).append(track)
+
+        urls = {}
+        for format, group in formats.items():
+            for start in range(0, len(group), MEDIA_BATCH_SIZE):
+                batch = group[start:][:MEDIA_BATCH_SIZE]
+                result = await self.get_track_urls(
+                    [track.raw["TRACK_TOKEN"] for track in batch], format
+                )
+                if len(result) != len(batch):
+                    # Pairing them up would hand tracks another track's
+                    # file and Blowfish key
+                    raise Exception(
+                        f"Deezer returned {len(result)} URLs"
+                        f" for {len(batch)} tracks"
+                    )
+
+                for track, url in zip(batch, result):
+                    urls[track.id] = url
 
-        return chunk
+        return urls
+
+    def decryptor(self, id: str | int, executor: Executor = None):
+        return StripeDecryptor(self._get_blowfish_key(id), executor)
 
     async def check_token(self):
-        user = await self._api_call("deezer.getUserData")
-        if user["USER"]["OPTIONS"]["streaming_group"] == "ads":
+        # The streaming group is cached by the session keeper
+        if self.streaming_group is None:
+            await self.renew_session()
+
+        if self.streaming_group == "ads":
             raise Exception("Free accounts are not eligible for downloading")
 
 
+def deezer_config() -> tuple:
+    return (
+        Settings.getdata("deezer_arl"),
+        Settings.getdata("deezer_client_id", "579939560"),
+        Settings.getdata(
+            "deezer_client_secret", "fa31fc13e7a28e7d70bb61e91aa9e178"
+        ),
+        Settings.getdata("deezer_bf_secret", "g4el58wc0zvf9na1"),
+        Settings.getdata("deezer_cache_size", 128),
+        Settings.PROXY,
+    )
+
+
 async def set_up_deezer():
     arl = Settings.getdata("deezer_arl")
     if len(arl) == 0:
@@ -514,21 +913,25 @@ async def set_up_deezer():
             "deezer_client_secret", "fa31fc13e7a28e7d70bb61e91aa9e178"
         )
         bf_secret = Settings.getdata("deezer_bf_secret", "g4el58wc0zvf9na1")
-        return await Deezer.create(client_id, client_secret, bf_secret, arl)
+        instance = await Deezer.create(
+            client_id, client_secret, bf_secret, arl
+        )
+        instance.config = deezer_config()
+        return instance
     except Exception as e:
         return f"**ERROR**: {e}"
 
 
 async def deezer_search_keyboard(query: str, page: int = 0):
     keyboard = []
-    tracks = await deezer.search_track(query, offset=page * 10, limit=11)
+    tracks, next_page = await deezer.searches.page(query, page)
 
     if not tracks:
         return InlineKeyboardMarkup(
             [[InlineKeyboardButton("No track was found.", "None")]]
         )
 
-    for track in tracks[:10]:
+    for track in tracks:
         keyboard.append(
             [
                 InlineKeyboardButton(
@@ -547,7 +950,7 @@ async def deezer_search_keyboard(query: str, page: int = 0):
         page_keyboard.append(
             InlineKeyboardButton("Previous Page", f"dese {query} {page-1}")
         )
-    if len(tracks) == 11:
+    if next_page:
         page_keyboard.append(
             InlineKeyboardButton("Next Page", f"dese {query} {page+1}")
         )
@@ -557,10 +960,42 @@ async def deezer_search_keyboard(query: str, page: int = 0):
 
 async def on_data_change():
     global deezer
-    deezer = await set_up_deezer()
+    close_tag_executors(
+        keep=get_tag_executor(*tag_executor_settings(Settings))
+    )
+    if configure_clients(**client_settings(Settings)):
+        await close_clients()
+    close_decrypt_executors(
+        keep=get_decrypt_executor(
+            Settings.getdata("deezer_decrypt_processes").is_enabled
+        )
+    )
+    async with _setup_lock:
+        # Settings of other plugins land here too, and a setup that is
+        # still running must not be started a second time
+        if isinstance(deezer, Deezer) and deezer.config == deezer_config():
+            return
+
+        if isinstance(deezer, Deezer):
+            await deezer.close()
+
+        await close_stale_clients(Settings.PROXY)
+        deezer = await set_up_deezer()
+
+
+async def get_deezer() -> "Deezer | str":
+    # The one lazy setup shared by the handlers and other plugins
+    global deezer
+    async with _setup_lock:
+        if deezer is None:
+            deezer = await set_up_deezer()
+
+    return deezer
 
 
+configure_clients(**client_settings(Settings))
 deezer = None
+_setup_lock = asyncio.Lock()
 
 
 @Bot.on_message(
@@ -573,9 +1008,7 @@ deezer = None
 )
 @error_handler_decorator
 async def deezer_message(_: Bot, message: Message):
-    global deezer
-    if deezer is None:
-        deezer = await set_up_deezer()
+    deezer = await get_deezer()
 
     if isinstance(deezer, str):
         await message.reply(deezer)
@@ -605,7 +1038,7 @@ async def deezer_message(_: Bot, message: Message):
             cover = await deezer.get_track_cover(track=data)
         else:
             data = await deezer.get_album(id)
-            cover = data["cover"]
+            cover = data.cover
 
         keyboard = []
         _keyboard = [
@@ -639,7 +1072,7 @@ async def deezer_message(_: Bot, message: Message):
                         parse_data("deezer pvtrack {id}", track),
                     ),
                 ]
-                for track in data["songs"]
+                for track in data.tracks
             ]
 
         await message.reply_photo(
@@ -656,9 +1089,7 @@ async def deezer_message(_: Bot, message: Message):
 )
 @error_handler_decorator
 async def deezer_callback(_: Bot, query: CallbackQuery):
-    global deezer
-    if deezer is None:
-        deezer = await set_up_deezer()
+    deezer = await get_deezer()
 
     if isinstance(deezer, str):
         await query.answer(deezer)
@@ -681,20 +1112,28 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
 
         if info["type"] == "dlalbum":
             album = await deezer.get_album(info["id"])
-            tracks = album["songs"]
+            tracks = album.tracks
         else:
             _track = await deezer.get_track(info["id"])
-            album = await deezer.get_album(_track["album_id"])
+            album = await deezer.get_album(_track.album_id)
+            _track.album = album
             tracks = [_track]
 
+        genre = asyncio.create_task(deezer.resolve_genre(album))
         _album_path = Settings.getdata("deezer_album_path", "{artist}/{name}")
+        _track_name = Settings.getdata(
+            "deezer_track_name", "{track_number} {name}"
+        )
+        if "{genre" in _album_path + _track_name:
+            await genre
+
         album_path = download_path + parse_data(_album_path, album) + "/"
-        zfill = max(2, len(str(album["tracks_count"])))
+        zfill = max(2, len(str(album.tracks_count)))
         os.makedirs(album_path, exist_ok=True)
 
         cover_path = album_path + "cover.jpg"
         if not os.path.exists(cover_path):
-            cover_url: str = album["cover"]
+            cover_url: str = album.cover
             cover_msg = await query.message.reply("Downloading **cover.jpg**.")
 
             if await error_handler(
@@ -720,17 +1159,12 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
                 cover_msg,
             )
 
-        downloads = 0
-        for track in tracks:
-            url = await deezer.get_file_url(track)
-            track["track_number"] = str(track["track_number"]).zfill(zfill)
+        tagger = TagBatch.from_settings(cover_path, Settings)
+
+        async def download_track(track: Track):
             track_msg = await query.message.reply(
                 parse_data("Downloading **{name}**.", track)
             )
-            _track_name = Settings.getdata(
-                "deezer_track_name", "{track_number} {name}"
-            )
-            track["format"] = track["format"].split("_")[0]
             track_name = parse_data(_track_name + ".{format}", track)
             full_path = album_path + track_name
             tmp_full_path = full_path + ".tmp"
@@ -746,9 +1180,9 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
                     lambda msg: asyncio.create_task(msg.delete()),
                     track_msg,
                 )
-                continue
+                return
 
-            if os.path.exists(tmp_full_path):
+            if is_downloading(tmp_full_path):
                 await track_msg.edit(
                     parse_data(
                         "Track **{name}** is already downloading.", track
@@ -759,47 +1193,96 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
                     lambda msg: asyncio.create_task(msg.delete()),
                     track_msg,
                 )
-                continue
+                return
 
             if (
                 not os.path.exists(full_path)
                 or Settings.getdata("force_download").is_enabled
             ):
+                url = urls.get(track.id) or await deezer.get_file_url(track)
+                if isinstance(url, Exception):
+                    await track_msg.edit(
+                        parse_data(
+                            "Track **{name}** is not available: ", track
+                        )
+                        + str(url)
+                    )
+                    return
+
                 if await error_handler(
                     download_file,
                     kwargs=dict(
                         url=url,
                         filename=tmp_full_path,
                         proxy=Settings.PROXY,
-                        chunk_size=2048,
-                        chunk_process=deezer.decrypt_chunk,
-                        chunk_process_args=(track["id"],),
+                        chunk_size=64 * 1024,
+                        transform=deezer.decryptor(
+                            track.id,
+                            get_decrypt_executor(
+                                Settings.getdata(
+                                    "deezer_decrypt_processes"
+                                ).is_enabled
+                            ),
+                        ),
+                        expected_size=track.file_size,
+                        refresh_url=deezer.get_file_url,
+                        refresh_url_args=(track,),
                         progress=download_progress,
                         progress_args=(track_name, time(), track_msg),
+                        segments=4,
                     ),
                     update=track_msg,
                     text=parse_data(
                         "Failed to download the track **{name}**.", track
                     ),
                 ):
-                    if os.path.exists(tmp_full_path):
-                        os.remove(tmp_full_path)
+                    remove_partial(tmp_full_path)
 
-                    continue
+                    return
                 else:
                     os.rename(tmp_full_path, full_path)
 
-            track["source"] = "Deezer"
-            track["album"] = album
-            track["date"] = album["release_date"]
-            track["lyrics"] = await deezer.get_track_lyrics(track["id"])
-            tag_file(full_path, cover_path, track)
+            track.lyrics = await deezer.get_track_lyrics(track.id)
+            await genre
+            tagger.add(full_path, track)
             loop.call_later(
                 5,
                 lambda msg: asyncio.create_task(msg.delete()),
                 track_msg,
             )
-            downloads += 1
+
+        for track in tracks:
+            track.track_number = str(track.track_number).zfill(zfill)
+
+        try:
+            urls = await deezer.get_file_urls(tracks)
+        except Exception:
+            # Fall back to resolving each track on its own
+            urls = {}
+
+        await gather_limited(
+            lambda track: error_handler(
+                download_track,
+                args=(track,),
+                update=query,
+                text=parse_data(
+                    "Failed to download the track **{name}**.", track
+                ),
+            ),
+            tracks,
+            int(Settings.getdata("deezer_concurrent_downloads", 3) or 1),
+        )
+
+        downloads = 0
+        for result in await tagger.wait():
+            if result.ok:
+                downloads += 1
+            else:
+                await query.message.reply(
+                    parse_data(
+                        "Failed to tag the track **{name}**.", result.track
+                    )
+                )
 
         if downloads == 0:
             return
@@ -835,12 +1318,12 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
     elif info["type"] == "pvtrack":
         await query.answer()
         track = await deezer.get_track(info["id"])
-        if not track["preview"]:
+        if not track.preview:
             await query.message.reply("There is no preview available.")
             return
 
         await query.message.reply_audio(
-            track["preview"],
+            track.preview,
             caption=parse_data(
                 "Preview for **{name}** by **{artist}**.", track
             ),
@@ -852,9 +1335,7 @@ async def deezer_callback(_: Bot, query: CallbackQuery):
 )
 @error_handler_decorator
 async def deezer_search(_: Bot, query: CallbackQuery):
-    global deezer
-    if deezer is None:
-        deezer = await set_up_deezer()
+    deezer = await get_deezer()
 
     if isinstance(deezer, str):
         await query.answer(deezer)
@@ -3,6 +3,7 @@ import time
 import httpx
 import hashlib
 import asyncio
+import logging
 from bot import Bot
 from pyrogram import filters
 from pyrogram.types import (
@@ -15,13 +16,34 @@ from .util import (
     download_file,
     download_progress,
     parse_data,
-    tag_file,
+    TagBatch,
+    get_tag_executor,
+    close_tag_executors,
+    tag_executor_settings,
+    Track,
+    Album,
+    close_clients,
+    close_stale_clients,
+    configure_clients,
+    client_settings,
+    is_downloading,
+    remove_partial,
+    UrlPrefetcher,
+    TTLCache,
+    SearchCache,
     error_handler,
     error_handler_decorator,
 )
 
 from bot.settings import Settings
 
+FLAC_FORMATS = {6, 7, 27}
+# Seconds the user/get result is trusted, it is refreshed in the
+# background a little before that
+CREDENTIAL_TTL = 900
+# Seconds album and track payloads are kept
+METADATA_TTL = 1800
+
 
 # Qobuz class from https://github.com/OrfiDev/orpheusdl-qobuz
 # with some modifications
@@ -32,12 +54,18 @@ class Qobuz:
         app_secret: str,
         auth_token: str,
         proxy: str = None,
+        cache_size: int = 256,
     ):
         self.api_base = "https://www.qobuz.com/api.json/0.2/"
         self._app_id = str(app_id)
         self._app_secret = app_secret
         self._auth_token = auth_token
         self.session = httpx.AsyncClient(proxy=proxy)
+        self.account = TTLCache(1, ttl=CREDENTIAL_TTL)
+        self.cache = TTLCache(cache_size, ttl=METADATA_TTL)
+        self.searches = SearchCache(self.search_track)
+        self._refresher: asyncio.Task | None = None
+        self.config = None
 
     def headers(self) -> dict[str, str]:
         return {
@@ -60,11 +88,15 @@ class Qobuz:
         )
 
         if response.status_code not in [200, 201, 202]:
+            if response.status_code in (401, 403):
+                # The token may have been revoked, ask again next time
+                self.account.clear()
+
             raise Exception(response.json()["message"])
 
         return response.json()
 
-    async def check_token(self):
+    async def get_user(self) -> dict:
         params = {
             "app_id": self._app_id,
         }
@@ -72,11 +104,33 @@ class Qobuz:
             "user/get", params
         )
 
-        response = await self._get("user/get", params)
+        return await self._get("user/get", params)
+
+    async def _refresh_account(self):
+        while True:
+            await asyncio.sleep(CREDENTIAL_TTL * 0.8)
+            try:
+                self.account.set("user", await self.get_user())
+            except Exception as e:
+                logging.debug("Refreshing the Qobuz account failed: %s", e)
+                self.account.clear()
+
+    async def check_token(self):
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh_account())
+
+        response = await self.account.get_or_fetch("user", self.get_user)
 
         if not response["credential"]["parameters"]:
             raise Exception("Free accounts are not eligible for downloading")
 
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+        await self.session.aclose()
+
     def create_signature(
         self, method: str, parameters: dict
     ) -> tuple[str, str]:
@@ -91,6 +145,61 @@ class Qobuz:
         signature = hashlib.md5(to_hash.encode()).hexdigest()
         return timestamp, signature
 
+    @staticmethod
+    def _artist(data: dict) -> str:
+        # The artists list wins over the performer, like parse_data did
+        if "artists" in data:
+            return ", ".join(artist["name"] for artist in data["artists"])
+
+        artist = data.get("performer") or data.get("artist") or {}
+        return artist.get("name", "")
+
+    def _track(self, data: dict, album: Album = None) -> Track:
+        if album is None and "album" in data:
+            album = self._album(data["album"])
+
+        return Track(
+            id=str(data["id"]),
+            title=data["title"],
+            version=data.get("version"),
+            artist=self._artist(data),
+            duration=data["duration"],
+            track_number=data.get("track_number", ""),
+            disc_number=data.get("media_number", ""),
+            composer=(data.get("composer") or {}).get("name", ""),
+            copyright=data.get("copyright"),
+            isrc=data.get("isrc"),
+            release_date=data.get("release_date_original"),
+            album_id=str(album.id) if album else None,
+            album=album,
+            source="Qobuz",
+            raw=data,
+        )
+
+    def _album(self, data: dict) -> Album:
+        album = Album(
+            id=str(data["id"]),
+            title=data["title"],
+            version=data.get("version"),
+            artist=self._artist(data),
+            main_artist=data["artist"]["name"],
+            genre=(data.get("genre") or {}).get("name", ""),
+            tracks_count=data.get("tracks_count", 0),
+            media_count=data.get("media_count", ""),
+            date=data.get("release_date_original", ""),
+            copyright=data.get("copyright"),
+            cover=data["image"]["large"],
+            duration=data.get("duration", 0),
+            source="Qobuz",
+            raw=data,
+        )
+        album.tracks = [
+            self._track(track, album)
+            for track in data.get("tracks", {}).get("items", [])
+        ]
+
+        return album
+
     async def search(
         self, query_type: str, query: str, offset: int = 0, limit: int = 10
     ) -> dict:
@@ -133,22 +242,48 @@ class Qobuz:
 
         return await self._get("track/getFileUrl", params=params)
 
-    async def get_track(self, track_id: str) -> dict:
-        return await self._get(
-            "track/get", params={"track_id": track_id, "app_id": self._app_id}
+    async def search_track(
+        self, query: str, offset: int = 0, limit: int = 10
+    ) -> list[Track]:
+        result = await self.search("track", query, offset, limit)
+        return [self._track(track) for track in result["tracks"]["items"]]
+
+    async def get_track(self, track_id: str) -> Track:
+        return self._track(
+            await self.cache.get_or_fetch(
+                ("track", str(track_id)),
+                lambda: self._get(
+                    "track/get",
+                    params={"track_id": track_id, "app_id": self._app_id},
+                ),
+            )
         )
 
-    async def get_album(self, album_id: str) -> dict:
-        return await self._get(
-            "album/get",
-            params={
-                "album_id": album_id,
-                "app_id": self._app_id,
-                "extra": "albumsFromSameArtist,focusAll",
-            },
+    async def get_album(self, album_id: str, extra: str = None) -> Album:
+        # Only the album and its tracks unless extra is asked for, e.g.
+        # "albumsFromSameArtist,focusAll"
+        params = {"album_id": album_id, "app_id": self._app_id}
+        if extra:
+            params["extra"] = extra
+
+        return self._album(
+            await self.cache.get_or_fetch(
+                ("album", str(album_id), extra),
+                lambda: self._get("album/get", params=params),
+            )
         )
 
 
+def qobuz_config() -> tuple:
+    return (
+        Settings.getdata("qobuz_app_id"),
+        Settings.getdata("qobuz_app_secret"),
+        Settings.getdata("qobuz_auth_token"),
+        Settings.getdata("qobuz_cache_size", 256),
+        Settings.PROXY,
+    )
+
+
 def set_up_qobuz():
     app_id = Settings.getdata("qobuz_app_id")
     app_secret = Settings.getdata("qobuz_app_secret")
@@ -173,20 +308,27 @@ def set_up_qobuz():
             )
         return error_message
 
-    return Qobuz(app_id, app_secret, auth_token, Settings.PROXY)
+    instance = Qobuz(
+        app_id,
+        app_secret,
+        auth_token,
+        Settings.PROXY,
+        int(Settings.getdata("qobuz_cache_size", 256)),
+    )
+    instance.config = qobuz_config()
+    return instance
 
 
 async def qobuz_search_keyboard(query: str, page: int = 0):
     keyboard = []
-    result = await qobuz.search("track", query, offset=page * 10, limit=11)
-    tracks = result["tracks"]["items"]
+    tracks, next_page = await qobuz.searches.page(query, page)
 
     if not tracks:
         return InlineKeyboardMarkup(
             [[InlineKeyboardButton("No track was found.", "None")]]
         )
 
-    for track in tracks[:10]:
+    for track in tracks:
         keyboard.append(
             [
                 InlineKeyboardButton(
@@ -205,7 +347,7 @@ async def qobuz_search_keyboard(query: str, page: int = 0):
         page_keyboard.append(
             InlineKeyboardButton("Previous Page", f"qose {query} {page-1}")
         )
-    if len(tracks) == 11:
+    if next_page:
         page_keyboard.append(
             InlineKeyboardButton("Next Page", f"qose {query} {page+1}")
         )
@@ -213,11 +355,24 @@ async def qobuz_search_keyboard(query: str, page: int = 0):
     return InlineKeyboardMarkup(keyboard + [page_keyboard])
 
 
-def on_data_change():
+async def on_data_change():
     global qobuz
+    close_tag_executors(
+        keep=get_tag_executor(*tag_executor_settings(Settings))
+    )
+    if configure_clients(**client_settings(Settings)):
+        await close_clients()
+    # Settings of other plugins land here too
+    if isinstance(qobuz, Qobuz) and qobuz.config == qobuz_config():
+        return
+    if isinstance(qobuz, Qobuz):
+        await qobuz.close()
+
+    await close_stale_clients(Settings.PROXY)
     qobuz = set_up_qobuz()
 
 
+configure_clients(**client_settings(Settings))
 qobuz = set_up_qobuz()
 
 
@@ -275,10 +430,10 @@ async def qobuz_message(_: Bot, message: Message):
                 parse_data("qobuz pvtrack {id}", track),
             ),
         ]
-        for track in album["tracks"]["items"]
+        for track in album.tracks
     ]
     await message.reply_photo(
-        album["image"]["large"],
+        album.cover,
         caption=parse_data("{name} - {artist}", album),
         reply_markup=InlineKeyboardMarkup(keyboard + tracks),
     )
@@ -310,20 +465,21 @@ async def qobuz_callback(_: Bot, query: CallbackQuery):
 
         if info["type"] == "dlalbum":
             album = await qobuz.get_album(info["id"])
-            tracks = album["tracks"]["items"]
+            tracks = album.tracks
         else:
             _track = await qobuz.get_track(info["id"])
-            album = await qobuz.get_album(_track["album"]["id"])
+            album = await qobuz.get_album(_track.album_id)
+            _track.album = album
             tracks = [_track]
 
         _album_path = Settings.getdata("qobuz_album_path", "{artist}/{name}")
         album_path = download_path + parse_data(_album_path, album) + "/"
-        zfill = max(2, len(str(album["tracks_count"])))
+        zfill = max(2, len(str(album.tracks_count)))
         os.makedirs(album_path, exist_ok=True)
 
         cover_path = album_path + "cover.jpg"
         if not os.path.exists(cover_path):
-            cover_url: str = album["image"]["large"].replace("600", "org")
+            cover_url: str = album.cover.replace("600", "org")
             cover_msg = await query.message.reply("Downloading **cover.jpg**.")
 
             if await error_handler(
@@ -349,80 +505,108 @@ async def qobuz_callback(_: Bot, query: CallbackQuery):
                 cover_msg,
             )
 
-        downloads = 0
-        for track in tracks:
-            stream_data = await qobuz.get_file_url(str(track["id"]))
-            track.update(stream_data)
-            track["track_number"] = str(track["track_number"]).zfill(zfill)
-            track_msg = await query.message.reply(
-                parse_data("Downloading **{name}**.", track)
-            )
-            _track_name = Settings.getdata(
-                "qobuz_track_name", "{track_number} {name}"
-            )
-            track_name = parse_data(_track_name + ".{format}", track)
-            full_path = album_path + track_name
-            tmp_full_path = full_path + ".tmp"
-            if os.path.exists(full_path) and (
-                not Settings.getdata("force_download").is_enabled
-                and not Settings.getdata("force_update").is_enabled
-            ):
-                await track_msg.edit(
-                    parse_data("Track **{name}** already exists.", track)
+        tagger = TagBatch.from_settings(cover_path, Settings)
+        urls = UrlPrefetcher(
+            qobuz.get_file_url,
+            [track.id for track in tracks],
+            int(Settings.getdata("qobuz_prefetch", 2) or 0),
+        )
+        try:
+            for track in tracks:
+                stream_data = await urls.get(track.id)
+                track.stream = stream_data
+                track.quality = str(stream_data["format_id"])
+                track.format = (
+                    "flac"
+                    if stream_data["format_id"] in FLAC_FORMATS
+                    else "mp3"
                 )
-                loop.call_later(
-                    5,
-                    lambda msg: asyncio.create_task(msg.delete()),
-                    track_msg,
+                track.track_number = str(track.track_number).zfill(zfill)
+                track_msg = await query.message.reply(
+                    parse_data("Downloading **{name}**.", track)
+                )
+                _track_name = Settings.getdata(
+                    "qobuz_track_name", "{track_number} {name}"
                 )
-                continue
+                track_name = parse_data(_track_name + ".{format}", track)
+                full_path = album_path + track_name
+                tmp_full_path = full_path + ".tmp"
+                if os.path.exists(full_path) and (
+                    not Settings.getdata("force_download").is_enabled
+                    and not Settings.getdata("force_update").is_enabled
+                ):
+                    await track_msg.edit(
+                        parse_data("Track **{name}** already exists.", track)
+                    )
+                    loop.call_later(
+                        5,
+                        lambda msg: asyncio.create_task(msg.delete()),
+                        track_msg,
+                    )
+                    continue
 
-            if os.path.exists(tmp_full_path):
-                await track_msg.edit(
-                    parse_data(
-                        "Track **{name}** is already downloading.", track
+                if is_downloading(tmp_full_path):
+                    await track_msg.edit(
+                        parse_data(
+                            "Track **{name}** is already downloading.", track
+                        )
                     )
-                )
+                    loop.call_later(
+                        5,
+                        lambda msg: asyncio.create_task(msg.delete()),
+                        track_msg,
+                    )
+                    continue
+
+                if (
+                    not os.path.exists(full_path)
+                    or Settings.getdata("force_download").is_enabled
+                ):
+                    if await error_handler(
+                        download_file,
+                        kwargs=dict(
+                            url=stream_data["url"],
+                            filename=tmp_full_path,
+                            proxy=Settings.PROXY,
+                            progress=download_progress,
+                            progress_args=(track_name, time.time(), track_msg),
+                            refresh_url=urls.refresh,
+                            refresh_url_args=(track.id,),
+                            segments=4,
+                        ),
+                        update=track_msg,
+                        text=parse_data(
+                            "Failed to download the track **{name}**.", track
+                        ),
+                    ):
+                        remove_partial(tmp_full_path)
+
+                        continue
+                    else:
+                        os.rename(tmp_full_path, full_path)
+
+                tagger.add(full_path, track)
                 loop.call_later(
                     5,
                     lambda msg: asyncio.create_task(msg.delete()),
                     track_msg,
                 )
-                continue
-
-            if (
-                not os.path.exists(full_path)
-                or Settings.getdata("force_download").is_enabled
-            ):
-                if await error_handler(
-                    download_file,
-                    kwargs=dict(
-                        url=stream_data["url"],
-                        filename=tmp_full_path,
-                        proxy=Settings.PROXY,
-                        progress=download_progress,
-                        progress_args=(track_name, time.time(), track_msg),
-                    ),
-                    update=track_msg,
-                    text=parse_data(
-                        "Failed to download the track **{name}**.", track
-                    ),
-                ):
-                    if os.path.exists(tmp_full_path):
-                        os.remove(tmp_full_path)
-
-                    continue
-                else:
-                    os.rename(tmp_full_path, full_path)
+        finally:
+            # Also when a URL lookup fails, so no prefetch is left
+            # running and the files already queued still get tagged
+            urls.close()
+            results = await tagger.wait()
 
-            track["source"] = "Qobuz"
-            tag_file(full_path, cover_path, track)
-            loop.call_later(
-                5,
-                lambda msg: asyncio.create_task(msg.delete()),
-                track_msg,
-            )
-            downloads += 1
+        downloads = 0
+        for result in results:
+            if result.ok:
+                downloads += 1
+            else:
+                await query.message.reply(
+                    parse_data(
+                        "Failed to tag the track **{name}**.", result.track
+                    )
+                )
 
         if downloads == 0:
             return
@@ -436,9 +620,9 @@ async def qobuz_callback(_: Bot, query: CallbackQuery):
     elif info["type"] == "trackinfo":
         await query.answer()
         track = await qobuz.get_track(info["id"])
-        album = await qobuz.get_album(track["album"]["id"])
+        album = await qobuz.get_album(track.album_id)
         await query.message.reply_photo(
-            album["image"]["large"],
+            album.cover,
             caption=parse_data("{name} - {artist}", track),
             reply_markup=InlineKeyboardMarkup(
                 [
@@ -458,7 +642,7 @@ async def qobuz_callback(_: Bot, query: CallbackQuery):
     elif info["type"] == "pvtrack":
         await query.answer()
         track = await qobuz.get_track(info["id"])
-        if not track["previewable"]:
+        if not track.raw.get("previewable"):
             await query.message.reply("There is no preview available.")
             return
 
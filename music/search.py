@@ -0,0 +1,164 @@
+import re
+import asyncio
+import unicodedata
+from bot import Bot
+from pyrogram import filters
+from pyrogram.types import (
+    Message,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+)
+from . import deezer as deezer_plugin, qobuz as qobuz_plugin
+from .util import parse_data, Track, error_handler_decorator
+
+from bot.settings import Settings
+
+RESULTS_LIMIT = 10
+# Seconds before a service that hasn't answered is given up on
+SEARCH_TIMEOUT = 10
+# Tracks whose durations differ by at most this many seconds match
+DURATION_TOLERANCE = 2
+
+
+def normalise(text: str) -> str:
+    text = unicodedata.normalize("NFKD", str(text or "").casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"[\W_]+", " ", text).strip()
+
+
+def main_artist(artist: str) -> str:
+    return normalise(re.split(r",|&| feat\.? | ft\.? ", artist or "")[0])
+
+
+class SearchResults:
+    """Tracks found on several services, merged by ISRC or by their
+    normalised title, main artist and duration."""
+
+    def __init__(self):
+        self.entries: list[dict[str, Track]] = []
+        self.status: dict[str, str] = {}
+
+    def find(self, track: Track) -> dict[str, Track] | None:
+        isrc = (track.isrc or "").upper()
+        name = normalise(track.name)
+        artist = main_artist(track.artist)
+        for entry in self.entries:
+            for other in entry.values():
+                if isrc and isrc == (other.isrc or "").upper():
+                    return entry
+                if (
+                    name == normalise(other.name)
+                    and artist == main_artist(other.artist)
+                    and abs(int(track.duration) - int(other.duration))
+                    <= DURATION_TOLERANCE
+                ):
+                    return entry
+
+        return None
+
+    def add(self, service: str, tracks: list[Track]):
+        for track in tracks:
+            entry = self.find(track)
+            if entry is None:
+                self.entries.append({service: track})
+            elif service not in entry:
+                entry[service] = track
+
+    def text(self, query: str) -> str:
+        return f"Results for **{query}**:\n" + " | ".join(
+            f"{service}: {status}" for service, status in self.status.items()
+        )
+
+    def keyboard(self) -> InlineKeyboardMarkup:
+        if not self.entries:
+            return InlineKeyboardMarkup(
+                [[InlineKeyboardButton("No track was found.", "None")]]
+            )
+
+        keyboard = []
+        for entry in self.entries:
+            service, track = next(iter(entry.items()))
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        parse_data("{time} | {name} - {artist}", track),
+                        parse_data(service.lower() + " trackinfo {id}", track),
+                    )
+                ]
+                + [
+                    InlineKeyboardButton(
+                        service,
+                        parse_data(service.lower() + " dltrack {id}", track),
+                    )
+                    for service, track in entry.items()
+                ]
+            )
+
+        return InlineKeyboardMarkup(keyboard)
+
+
+async def search_deezer(query: str) -> list[Track]:
+    deezer = await deezer_plugin.get_deezer()
+    if isinstance(deezer, str):
+        raise Exception("not set up")
+
+    return await deezer.search_track(query, 0, RESULTS_LIMIT)
+
+
+async def search_qobuz(query: str) -> list[Track]:
+    if isinstance(qobuz_plugin.qobuz, str):
+        raise Exception("not set up")
+
+    return await qobuz_plugin.qobuz.search_track(query, 0, RESULTS_LIMIT)
+
+
+SERVICES = {"Deezer": search_deezer, "Qobuz": search_qobuz}
+
+
+@Bot.on_message(
+    Settings.IS_ADMIN
+    & filters.regex(
+        rf"^{Settings.REGEX_CMD_PREFIXES}search(?: (?P<query>.+))?$"
+    )
+)
+@error_handler_decorator
+async def search_message(_: Bot, message: Message):
+    query = message.matches[0].group("query")
+    if not query:
+        await message.reply(f"{Settings.CMD_PREFIXES[0]}search [query]")
+        return
+
+    results = SearchResults()
+    results.status = {service: "searching" for service in SERVICES}
+    reply = await message.reply(results.text(query))
+
+    async def search(service: str):
+        # deezer_search_timeout, qobuz_search_timeout
+        timeout = float(
+            Settings.getdata(
+                f"{service.lower()}_search_timeout", SEARCH_TIMEOUT
+            )
+            or SEARCH_TIMEOUT
+        )
+        try:
+            tracks = await asyncio.wait_for(SERVICES[service](query), timeout)
+        except asyncio.TimeoutError:
+            results.status[service] = "timed out"
+        except Exception as e:
+            results.status[service] = f"failed ({e})"
+        else:
+            results.add(service, tracks)
+            results.status[service] = f"{len(tracks)} tracks"
+
+    # The keyboard is shown with the first answer and grows as the
+    # other services reply
+    for task in asyncio.as_completed(
+        [search(service) for service in SERVICES]
+    ):
+        await task
+        await reply.edit(results.text(query), reply_markup=results.keyboard())
+
+
+__all__ = ("search_message",)
+__plugin__ = True
+__bot_only__ = True
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import (
+    Executor,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+)
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.decrepit.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+
+# Deezer's BF_CBC_STRIPE decryption. It only needs cryptography, so
+# worker processes and scripts/bench_deezer_decrypt.py can import it
+# without the bot.
+
+BLOCK_SIZE = 2048
+STRIPE_IV = b"\x00\x01\x02\x03\x04\x05\x06\x07"
+DECRYPT_WORKERS = min(4, os.cpu_count() or 1)
+_decrypt_executors: dict[bool, Executor] = {}
+
+
+def get_decrypt_executor(processes: bool = False) -> Executor:
+    # Blowfish runs without the GIL, the XOR that undoes the chaining
+    # holds it. Only a process pool spreads that part over the cores.
+    executor = _decrypt_executors.get(processes)
+    if executor is None:
+        if processes:
+            executor = ProcessPoolExecutor(DECRYPT_WORKERS)
+        else:
+            executor = ThreadPoolExecutor(DECRYPT_WORKERS, "decrypt")
+        _decrypt_executors[processes] = executor
+
+    return executor
+
+
+def close_decrypt_executors(wait: bool = False, keep: Executor = None):
+    # Like close_tag_executors, replaced pools finish their queued work
+    for key, executor in list(_decrypt_executors.items()):
+        if executor is keep:
+            continue
+
+        del _decrypt_executors[key]
+        executor.shutdown(wait=wait, cancel_futures=not wait and not keep)
+
+
+def decrypt_stripes(
+    key: bytes, index: int, data: bytes, block_size: int = BLOCK_SIZE
+) -> bytes:
+    # Every third block is Blowfish CBC with the IV reset per block.
+    # All of them go through a single ECB pass, the CBC chaining is then
+    # undone with one XOR against the shifted ciphertext.
+    end = len(data) - len(data) % block_size
+    starts = range(-index % 3 * block_size, end, 3 * block_size)
+    if not starts:
+        return data
+
+    view = memoryview(data)
+    blocks = [view[start:][:block_size] for start in starts]
+    encrypted = b"".join(blocks)
+    chained = b"".join(STRIPE_IV + block[:-8] for block in blocks)
+    decryptor = Cipher(
+        algorithms.Blowfish(key), modes.ECB(), backend=default_backend()
+    ).decryptor()
+    decrypted = (
+        int.from_bytes(decryptor.update(encrypted), "big")
+        ^ int.from_bytes(chained, "big")
+    ).to_bytes(len(encrypted), "big")
+
+    result = bytearray(data)
+    plain = memoryview(decrypted)
+    for start in starts:
+        stop = start + block_size
+        result[start:stop], plain = plain[:block_size], plain[block_size:]
+
+    return bytes(result)
+
+
+__util__ = True
@@ -1,12 +1,26 @@
+import io
 import os
-import copy
+import re
+import json
 import time
+import random
+import string
 import httpx
 import logging
 import asyncio
 import datetime
+import functools
 import traceback
+import email.utils
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from mutagen import PaddingInfo
 from mutagen.mp3 import MP3
+from concurrent.futures import (
+    Executor,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+)
 from typing import Callable
 from pyrogram import errors
 from mutagen.id3 import PictureType
@@ -27,6 +41,33 @@ from mutagen.id3 import (
     APIC,
 )
 
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+HTTP2 = h2 is not None
+DEFAULT_CLIENT_LIMITS = httpx.Limits(
+    max_connections=32, max_keepalive_connections=16, keepalive_expiry=60
+)
+CLIENT_LIMITS = DEFAULT_CLIENT_LIMITS
+_clients: dict[str | None, httpx.AsyncClient] = {}
+WRITE_BUFFER_SIZE = 2 * 1024 * 1024
+TRANSFORM_BATCH_SIZE = 256 * 1024
+CHECKPOINT_SUFFIX = ".checkpoint"
+_downloading: set[str] = set()
+TAG_WORKERS = min(4, os.cpu_count() or 1)
+_tag_executors: dict[tuple[int, bool], Executor] = {}
+COVER_MAX_SIZE = 1400
+COVER_MAX_BYTES = 1024 * 1024
+TAG_PADDING = 128 * 1024
+
 
 async def error_handler(
     func: Callable,
@@ -79,69 +120,1099 @@ def error_handler_decorator(func: Callable):
     return wrapper
 
 
-async def download_file(
-    url: str,
-    filename: str,
-    proxy: str = None,
-    chunk_size: int = None,
-    chunk_process: Callable = None,
-    chunk_process_args: tuple = None,
-    progress: Callable = None,
-    progress_args: tuple = None,
-    retry: int = 3,
+def get_client(proxy: str = None) -> httpx.AsyncClient:
+    client = _clients.get(proxy)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            proxy=proxy, http2=HTTP2, limits=CLIENT_LIMITS
+        )
+        _clients[proxy] = client
+
+    return client
+
+
+def configure_clients(
+    max_connections: int = None,
+    max_keepalive_connections: int = None,
+    keepalive_expiry: float = None,
+    http2: bool = None,
+) -> bool:
+    # Unset values fall back to the defaults, http2 to auto-detection.
+    # Returns whether anything changed, open clients keep the old limits
+    # until they are closed.
+    global CLIENT_LIMITS, HTTP2
+    defaults = DEFAULT_CLIENT_LIMITS
+    limits = httpx.Limits(
+        max_connections=max_connections or defaults.max_connections,
+        max_keepalive_connections=(
+            max_keepalive_connections or defaults.max_keepalive_connections
+        ),
+        keepalive_expiry=keepalive_expiry or defaults.keepalive_expiry,
+    )
+    http2 = h2 is not None and (http2 is None or http2)
+    if limits == CLIENT_LIMITS and http2 == HTTP2:
+        return False
+
+    CLIENT_LIMITS, HTTP2 = limits, http2
+    return True
+
+
+def client_settings(settings) -> dict:
+    http2 = settings.getdata("http2")
+    return dict(
+        max_connections=int(settings.getdata("http_max_connections", 0) or 0),
+        max_keepalive_connections=int(
+            settings.getdata("http_max_keepalive_connections", 0) or 0
+        ),
+        keepalive_expiry=float(
+            settings.getdata("http_keepalive_expiry", 0) or 0
+        ),
+        http2=http2.is_enabled if http2 else None,
+    )
+
+
+async def close_clients(proxies=None):
+    proxies = list(_clients) if proxies is None else proxies
+    clients = [_clients.pop(proxy) for proxy in proxies if proxy in _clients]
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception:
+            logging.debug(traceback.format_exc())
+
+
+async def close_stale_clients(proxy: str = None):
+    # The pool is shared by every plugin, only the clients of a proxy
+    # that is no longer configured go away so running downloads survive
+    await close_clients([key for key in _clients if key != proxy])
+
+
+class TTLCache:
+    """LRU mapping of at most maxsize entries that expire after a TTL.
+
+    get_or_fetch() shares one fetch between concurrent callers asking
+    for the same key, only successful results are stored.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        self.pending: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key) -> bool:
+        entry = self.data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def _lookup(self, key):
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.data[key]
+            return MISSING
+
+        self.data.move_to_end(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is MISSING:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+
+        self.data[key] = (time.monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self.data),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+        )
+
+    async def get_or_fetch(self, key, fetch: Callable, ttl: float = None):
+        value = self._lookup(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+
+        # Only the caller that starts the fetch counts as a miss
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(fetch())
+            self.pending[key] = task
+            task.add_done_callback(functools.partial(self._fetched, key, ttl))
+        else:
+            self.coalesced += 1
+
+        # A cancelled caller must not cancel the fetch of the others
+        return await asyncio.shield(task)
+
+    def _fetched(self, key, ttl: float, task: asyncio.Future):
+        self.pending.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result(), ttl)
+
+
+class SearchCache:
+    """Serves result pages from cached windows of window_size results.
+
+    search(query, offset, limit) is called once per window. When a page
+    reaches the last page of its window, the next window is fetched in
+    the background.
+    """
+
+    def __init__(
+        self,
+        search: Callable,
+        window_size: int = 50,
+        page_size: int = 10,
+        ttl: float = 300,
+        maxsize: int = 64,
+    ):
+        self.search = search
+        self.window_size = window_size
+        self.page_size = page_size
+        self.windows = TTLCache(maxsize, ttl)
+
+    async def window(self, query: str, index: int) -> list:
+        return await self.windows.get_or_fetch(
+            (query, index),
+            lambda: self.search(
+                query, index * self.window_size, self.window_size
+            ),
+        )
+
+    async def _prefetch(self, query: str, index: int):
+        try:
+            await self.window(query, index)
+        except Exception:
+            logging.debug(traceback.format_exc())
+
+    async def page(self, query: str, page: int) -> tuple[list, bool]:
+        # Returns the page and whether another one follows it
+        index, offset = divmod(page * self.page_size, self.window_size)
+        window = await self.window(query, index)
+        end = offset + self.page_size
+        results = window[offset:end]
+        if len(window) < self.window_size:
+            return results, end < len(window)
+
+        if end + self.page_size >= self.window_size:
+            key = (query, index + 1)
+            if key not in self.windows and key not in self.windows.pending:
+                asyncio.ensure_future(self._prefetch(query, index + 1))
+        if end < self.window_size:
+            return results, True
+
+        return results, bool(await self.window(query, index + 1))
+
+
+class DownloadError(Exception):
+    """The partial file can't be trusted and has to be fetched again."""
+
+
+class SizeMismatchError(DownloadError):
+    """The server has a different file than the one that was expected,
+    fetching it again won't change that."""
+
+
+class RetryPolicy:
+    """Decides whether and when a failed download is tried again.
+
+    Delays grow exponentially with full jitter and a Retry-After header
+    takes precedence. Permanent 4xx responses fail at once, expired
+    signed URLs are refreshed instead of requested again.
+    """
+
+    RETRY = "retry"
+    RESET = "reset"
+    REFRESH = "refresh"
+    FAIL = "fail"
+
+    retryable_statuses = {408, 425, 429}
+    expired_statuses = {401, 403, 410}
+
+    def __init__(
+        self,
+        retries: int = 3,
+        base_delay: float = 1,
+        max_delay: float = 30,
+        multiplier: float = 2,
+        jitter: bool = True,
+    ):
+        if not str(retries).isdigit() or retries < 0:
+            retries = 1
+
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def classify(self, error: Exception) -> str:
+        if isinstance(error, SizeMismatchError):
+            return self.FAIL
+        if isinstance(error, DownloadError):
+            return self.RESET
+        if not isinstance(error, httpx.HTTPStatusError):
+            return self.RETRY
+
+        status = error.response.status_code
+        if status in self.expired_statuses:
+            return self.REFRESH
+        if status == 416:
+            # Our offset is past the end, the partial file is wrong
+            return self.RESET
+        if 400 <= status < 500 and status not in self.retryable_statuses:
+            return self.FAIL
+
+        return self.RETRY
+
+    def delay(self, attempt: int, error: Exception = None) -> float:
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = self.retry_after(error.response)
+            if retry_after is not None:
+                return min(retry_after, self.max_delay * 4)
+
+        delay = min(self.max_delay, self.base_delay * self.multiplier**attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    @staticmethod
+    def retry_after(response: httpx.Response) -> float | None:
+        value = response.headers.get("retry-after")
+        if not value:
+            return None
+        if value.isdigit():
+            return float(value)
+
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        return max(
+            0, (date - datetime.datetime.now(date.tzinfo)).total_seconds()
+        )
+
+    @staticmethod
+    def expired(url: str, margin: int = 30) -> bool:
+        expires = url_expiry(url)
+        return expires is not None and expires - margin <= time.time()
+
+
+def content_range_total(response: httpx.Response) -> int | None:
+    total = response.headers.get("content-range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+async def probe_range(client: httpx.AsyncClient, url: str):
+    # Returns the full size when the server honours Range, None otherwise
+    headers = {"Range": "bytes=0-0"}
+    async with client.stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            return None, response.headers
+
+        return content_range_total(response), response.headers
+
+
+class SourceSelector:
+    """Ranks mirror URLs of the same file by how fast their host is.
+
+    Time to first byte and throughput are kept per host as decaying
+    averages, a failure makes a host look slow for failure_penalty
+    seconds. Hosts without samples are probed with a one byte Range
+    request before the first pick.
+    """
+
+    def __init__(
+        self,
+        decay: float = 0.3,
+        failure_penalty: float = 60,
+        probe_timeout: float = 5,
+    ):
+        self.decay = decay
+        self.failure_penalty = failure_penalty
+        self.probe_timeout = probe_timeout
+        self.hosts: dict[str, dict] = {}
+
+    @staticmethod
+    def host(url: str) -> str:
+        return httpx.URL(url).netloc.decode()
+
+    def _average(self, old: float | None, new: float) -> float:
+        if old is None:
+            return new
+
+        return old + self.decay * (new - old)
+
+    def record(
+        self,
+        url: str,
+        latency: float = None,
+        throughput: float = None,
+        failed: bool = False,
+    ):
+        stats = self.hosts.setdefault(
+            self.host(url),
+            dict(latency=None, throughput=None, failed_at=None),
+        )
+        if latency is not None:
+            stats["latency"] = self._average(stats["latency"], latency)
+        if throughput:
+            stats["throughput"] = self._average(
+                stats["throughput"], throughput
+            )
+        if failed:
+            stats["failed_at"] = time.monotonic()
+
+    def score(self, url: str) -> float | None:
+        # Estimated seconds to fetch the first megabyte, lower is better
+        stats = self.hosts.get(self.host(url))
+        if stats is None or stats["latency"] is None:
+            return None
+
+        score = stats["latency"]
+        if stats["throughput"]:
+            score += 1024 * 1024 / stats["throughput"]
+        if stats["failed_at"] is not None:
+            score += max(
+                0,
+                self.failure_penalty - (time.monotonic() - stats["failed_at"]),
+            )
+
+        return score
+
+    async def probe(self, client: httpx.AsyncClient, url: str):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                probe_range(client, url), self.probe_timeout
+            )
+        except Exception:
+            self.record(url, failed=True, latency=self.probe_timeout)
+        else:
+            self.record(url, latency=time.monotonic() - started)
+
+    async def rank(
+        self, urls: list[str], client: httpx.AsyncClient = None
+    ) -> list[str]:
+        if len(urls) < 2:
+            return list(urls)
+
+        if client is not None:
+            unknown = {}
+            for url in urls:
+                if self.score(url) is None:
+                    unknown.setdefault(self.host(url), url)
+
+            await asyncio.gather(
+                *(self.probe(client, url) for url in unknown.values())
+            )
+
+        # Unknown hosts go last, ties keep the server's order
+        return sorted(
+            urls,
+            key=lambda url: (
+                self.score(url) is None,
+                self.score(url) or 0,
+            ),
+        )
+
+
+sources = SourceSelector()
+
+
+async def gather_or_cancel(*coros):
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        done, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION
+        )
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    for task in pending:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    # Every error is retrieved, the first one is raised
+    failures = [task.exception() for task in done if not task.cancelled()]
+    for error in failures:
+        if error:
+            raise error
+
+    return [task.result() for task in tasks]
+
+
+async def gather_limited(func: Callable, items, limit: int) -> list:
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await gather_or_cancel(*(run(item) for item in items))
+
+
+class StreamTransform:
+    """Processes downloaded data before it is written.
+
+    process() receives the index of the first block and a buffer made
+    of whole blocks, only the last buffer of a stream may end with a
+    partial block. It returns the processed buffer.
+    """
+
+    block_size: int = 1
+
+    async def process(self, index: int, data: bytes) -> bytes:
+        return data
+
+
+async def transform_stream(
+    chunks, transform: StreamTransform, position: int = 0
 ):
-    progress_args = progress_args or ()
+    block_size = transform.block_size
+    batch_size = max(1, TRANSFORM_BATCH_SIZE // block_size) * block_size
+    index = position // block_size
+    buffer = bytearray()
 
-    if not str(retry).isdigit() or retry < 0:
-        retry = 1
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) < batch_size:
+            continue
 
-    async def download(client: httpx.AsyncClient, start: int = 0):
-        headers = {"Range": f"bytes={start}-"} if start > 0 else {}
-        async with client.stream("GET", url, headers=headers) as response:
-            response.raise_for_status()
-            total_size = int(response.headers.get("content-length", 0)) + start
-            downloaded = start
-            last_update = time.monotonic()
+        size = len(buffer) - len(buffer) % block_size
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        yield await transform.process(index, data)
+        index += size // block_size
+
+    if buffer:
+        yield await transform.process(index, bytes(buffer))
+
+
+class FileWriter:
+    """Coalesces chunks and writes them from an executor thread.
+
+    At most max_pending buffers wait on the executor, write() blocks
+    the caller beyond that. Use a single worker executor so the buffers
+    land in order.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        position: int,
+        executor: ThreadPoolExecutor,
+        buffer_size: int = WRITE_BUFFER_SIZE,
+        max_pending: int = 4,
+    ):
+        if not os.path.exists(filename):
+            open(filename, "wb").close()
+
+        self.file = open(filename, "r+b", buffering=0)
+        self.file.seek(position)
+        self.position = position
+        self.executor = executor
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.allocated = 0
+        self._pending = asyncio.Semaphore(max_pending)
+        self._futures: list[asyncio.Future] = []
+
+    async def _run(self, func: Callable, *args):
+        await self._pending.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+
+        for future in [f for f in self._futures if f.done()]:
+            self._futures.remove(future)
+            future.result()
+
+    def _preallocate(self, size: int):
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Not supported here, fall back to a sparse file
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+
+    async def preallocate(self, size: int):
+        self.allocated = size
+        await self._run(self._preallocate, size)
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+
+        data, self.buffer = self.buffer, bytearray()
+        await self._run(self._write, data)
+
+    def _write(self, data: bytearray):
+        view = memoryview(data)
+        while view:
+            written = self.file.write(view)
+            view = view[written:]
+
+        self.position += len(data)
+
+    async def close(self, truncate: bool = False):
+        try:
+            await self.flush()
+            await asyncio.gather(*self._futures)
+        finally:
+            self._futures.clear()
+            if truncate and self.allocated > self.position:
+                # Drop the preallocated space we never filled
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.file.truncate, self.position
+                )
+
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.file.close
+            )
+
+
+def is_downloading(filename: str) -> bool:
+    return os.path.abspath(filename) in _downloading
+
+
+def url_expiry(url: str) -> int | None:
+    # Deezer signs with hdnea=exp=..., Qobuz with etsp=...
+    match = re.search(r"\b(?:exp|etsp)=(\d+)", url)
+    return int(match.group(1)) if match else None
+
+
+class UrlPrefetcher:
+    """Resolves signed URLs for the next tracks ahead of time.
+
+    get() returns the result for a key and starts fetching the following
+    `ahead` keys. A cached result is reused until its URL is about to
+    expire, then it is signed again. fetch may return the URL itself or
+    a dict holding it under "url".
+    """
+
+    def __init__(
+        self, fetch: Callable, keys: list, ahead: int = 2, margin: int = 60
+    ):
+        self.fetch = fetch
+        self.keys = list(keys)
+        self.ahead = ahead
+        self.margin = margin
+        self.tasks: dict = {}
+
+    @staticmethod
+    def _url(result: str | dict) -> str:
+        return result["url"] if isinstance(result, dict) else result
+
+    def _start(self, key) -> asyncio.Future:
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.ensure_future(self.fetch(key))
+
+        return self.tasks[key]
+
+    def _valid(self, result: str | dict) -> bool:
+        expiry = url_expiry(self._url(result))
+        return expiry is None or expiry - self.margin > time.time()
+
+    async def get(self, key) -> str | dict:
+        if key in self.keys:
+            index, ahead = self.keys.index(key) + 1, self.ahead
+            for upcoming in self.keys[index:][:ahead]:
+                self._start(upcoming)
+
+        try:
+            result = await asyncio.shield(self._start(key))
+            if not self._valid(result):
+                del self.tasks[key]
+                result = await asyncio.shield(self._start(key))
+        except Exception:
+            # Don't keep a failed lookup around
+            self.tasks.pop(key, None)
+            raise
+
+        return result
+
+    async def url(self, key) -> str:
+        return self._url(await self.get(key))
+
+    async def refresh(self, key) -> str:
+        # The server refused the URL, sign a new one
+        self.tasks.pop(key, None)
+        return await self.url(key)
+
+    def close(self):
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Retrieved so a failed prefetch isn't logged as unhandled
+                task.exception()
+
+        self.tasks.clear()
+
+
+def load_checkpoint(filename: str) -> dict:
+    try:
+        with open(filename + CHECKPOINT_SUFFIX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_checkpoint(filename: str, checkpoint: dict):
+    path = filename + CHECKPOINT_SUFFIX
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+
+    os.replace(path + ".tmp", path)
+
+
+def remove_partial(filename: str):
+    for path in (filename, filename + CHECKPOINT_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Download:
+    """One file fetched from one or several mirrors of the same URL.
+
+    A single stream resumes from the checkpoint offset, a segmented
+    download keeps a [position, end) range per connection. The
+    checkpoint next to the file records either one so a later run goes
+    on where this one stopped. The retry policy decides what a failed
+    attempt does to the partial file.
+    """
+
+    def __init__(
+        self,
+        url: str | list[str],
+        filename: str,
+        proxy: str = None,
+        chunk_size: int = None,
+        transform: StreamTransform = None,
+        progress: Callable = None,
+        progress_args: tuple = None,
+        retry: int | RetryPolicy = 3,
+        refresh_url: Callable = None,
+        refresh_url_args: tuple = None,
+        segments: int = 1,
+        segment_min_size: int = 8 * 1024 * 1024,
+        preallocate: bool = True,
+        expected_size: int = None,
+        selector: SourceSelector = None,
+    ):
+        self.filename = filename
+        self.proxy = proxy
+        self.chunk_size = chunk_size
+        self.transform = transform
+        self.block_size = transform.block_size if transform else 1
+        self.progress = progress
+        self.progress_args = progress_args or ()
+        self.policy = (
+            retry if isinstance(retry, RetryPolicy) else RetryPolicy(retry)
+        )
+        self.refresh_url = refresh_url
+        self.refresh_url_args = refresh_url_args or ()
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.preallocate = preallocate
+        self.expected_size = expected_size
+        self.selector = selector or sources
+        # Several URLs are mirrors of the same file, the fastest host wins
+        self.candidates = [url] if isinstance(url, str) else list(url)
+        self.url = self.candidates[0]
+
+        self.downloaded = 0
+        self.total_size = 0
+        self.last_update = time.monotonic()
+        self.writers: dict[int, FileWriter] = {}
+        self.executor: ThreadPoolExecutor = None
+        self.checkpoint = (
+            load_checkpoint(filename) if os.path.exists(filename) else {}
+        )
+        self.checkpoint["expires"] = url_expiry(self.url)
+        # [position, end) per segment, [] for a single stream and None
+        # until that is decided
+        self.ranges: list[list[int]] | None = None
+        self._restore()
+
+    def _restore(self):
+        checkpoint = self.checkpoint
+        if not checkpoint.get("segments"):
+            return
+        if os.path.getsize(self.filename) != checkpoint.get("size"):
+            # The segment map doesn't match the file anymore
+            self.reset()
+            return
+
+        self.ranges = [
+            [position - position % self.block_size, end]
+            for position, end in checkpoint["segments"]
+        ]
+        self.total_size = checkpoint["size"]
+        self.downloaded = self.total_size - sum(
+            end - position for position, end in self.ranges
+        )
+
+    async def _use(self, result: str | list[str], client: httpx.AsyncClient):
+        candidates = [result] if isinstance(result, str) else list(result)
+        self.candidates = await self.selector.rank(candidates, client)
+        self.url = self.candidates[0]
+        self.checkpoint["expires"] = url_expiry(self.url)
+
+    async def _refresh(self, client: httpx.AsyncClient):
+        await self._use(await self.refresh_url(*self.refresh_url_args), client)
+
+    async def _save(self):
+        if self.ranges:
+            writers = self.writers
+            self.checkpoint["segments"] = [
+                [writers[i].position if i in writers else position, end]
+                for i, (position, end) in enumerate(self.ranges)
+            ]
+        elif 0 in self.writers:
+            self.checkpoint["offset"] = self.writers[0].position
+
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            save_checkpoint,
+            self.filename,
+            dict(self.checkpoint),
+        )
+
+    async def _report(self, force: bool = False):
+        if not force and time.monotonic() - self.last_update < 2:
+            return
+
+        self.last_update = time.monotonic()
+        await self._save()
+        if self.progress:
+            await self.progress(
+                self.downloaded, self.total_size, *self.progress_args
+            )
+
+    def _remember(self, headers: httpx.Headers):
+        self.checkpoint.update(
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+        )
+
+    def _validator(self) -> dict:
+        # Weak ETags are not allowed in If-Range
+        etag = self.checkpoint.get("etag")
+        if etag and not etag.startswith("W/"):
+            return {"If-Range": etag}
+        if self.checkpoint.get("last_modified"):
+            return {"If-Range": self.checkpoint["last_modified"]}
+
+        return {}
+
+    def _read(self, response: httpx.Response, position: int):
+        chunks = response.aiter_bytes(self.chunk_size)
+        if self.transform:
+            chunks = transform_stream(chunks, self.transform, position)
 
-            with open(filename, "ab") as file:
-                i = start // chunk_size if chunk_size else 0
-                async for chunk in response.aiter_bytes(chunk_size):
-                    if chunk_process:
-                        chunk = await chunk_process(
-                            i, chunk, *chunk_process_args
-                        )
+        return chunks
 
-                    file.write(chunk)
-                    downloaded += len(chunk)
+    def _resume_position(self) -> int:
+        if not os.path.exists(self.filename):
+            return 0
 
-                    if time.monotonic() - last_update >= 2:
-                        if progress:
-                            await progress(
-                                downloaded, total_size, *progress_args
-                            )
+        size = os.path.getsize(self.filename)
+        # Anything past the checkpoint may be preallocated space
+        position = min(self.checkpoint.get("offset", size), size)
+        # Resume on a block boundary so the transform stays aligned
+        position -= position % self.block_size
+        if position < size:
+            os.truncate(self.filename, position)
 
-                        last_update = time.monotonic()
+        return position
 
-                    i += 1
+    def _split(self, total_size: int) -> list[list[int]]:
+        count = min(self.segments, -(-total_size // self.segment_min_size))
+        size = -(-total_size // count)
+        # Keep block indexes identical to a single stream download
+        size = -(-size // self.block_size) * self.block_size
 
-            if progress:
-                await progress(downloaded, total_size, *progress_args)
+        return [
+            [position, min(position + size, total_size)]
+            for position in range(0, total_size, size)
+        ]
 
-    async with httpx.AsyncClient(proxy=proxy) as client:
-        for n in range(retry + 1):
+    def check_size(self, total: int | None):
+        # Called as soon as the headers tell the size of the remote file
+        if self.expected_size and total and total != self.expected_size:
+            raise SizeMismatchError(
+                f"Expected {self.expected_size} bytes, the server has {total}"
+            )
+
+    def verify(self):
+        size = os.path.getsize(self.filename)
+        expected = self.expected_size or self.checkpoint.get("size")
+        if not expected:
+            return
+
+        self.check_size(self.checkpoint.get("size"))
+        if size > expected:
+            raise DownloadError(
+                f"Downloaded {size} bytes, expected {expected}"
+            )
+        if size < expected:
+            # Not corrupt, the next attempt fetches what is missing
+            raise Exception(f"Downloaded {size} of {expected} bytes")
+
+    def reset(self):
+        remove_partial(self.filename)
+        self.checkpoint = dict(expires=self.checkpoint.get("expires"))
+        self.ranges = None
+
+    async def probe(self, client: httpx.AsyncClient):
+        # Splits the file when the server honours Range, otherwise it
+        # is fetched as a single stream
+        total_size, headers = await probe_range(client, self.url)
+        self.check_size(total_size)
+        self.ranges = self._split(total_size) if total_size else []
+        self._remember(headers)
+        if len(self.ranges) < 2:
+            self.ranges = []
+            return
+
+        writer = FileWriter(self.filename, 0, self.executor)
+        if self.preallocate:
+            await writer.preallocate(total_size)
+        await writer.close()
+        # Segments write in place, the file must be full size
+        if os.path.getsize(self.filename) < total_size:
+            os.truncate(self.filename, total_size)
+
+        self.checkpoint["size"] = total_size
+        self.downloaded, self.total_size = 0, total_size
+        await self._save()
+
+    async def stream(self, client: httpx.AsyncClient, start: int = 0):
+        headers = {}
+        if start > 0:
+            headers = {"Range": f"bytes={start}-", **self._validator()}
+
+        sent = time.monotonic()
+        async with client.stream("GET", self.url, headers=headers) as response:
+            self.selector.record(self.url, latency=time.monotonic() - sent)
+            response.raise_for_status()
+            if start > 0 and response.status_code != 206:
+                # The file changed or the server ignored Range, start over
+                start = 0
+                open(self.filename, "wb").close()
+            elif start > 0 and content_range_total(response) not in (
+                None,
+                self.checkpoint.get("size"),
+            ):
+                raise DownloadError("The remote file changed")
+
+            # A resumed response tells the full size in Content-Range,
+            # Content-Length only covers the rest of the file
+            total = content_range_total(response) if start else None
+            if total is None and "content-length" in response.headers:
+                total = int(response.headers["content-length"]) + start
+            self.check_size(total)
+
+            self.downloaded, self.total_size = start, total or 0
+            self.checkpoint["offset"] = start
+            if total:
+                self.checkpoint["size"] = total
+            elif not start:
+                self.checkpoint.pop("size", None)
+            self._remember(response.headers)
+
+            writer = self.writers[0] = FileWriter(
+                self.filename, start, self.executor
+            )
+            try:
+                if self.preallocate and total:
+                    await writer.preallocate(total)
+                    # Without it a crash would make the space look downloaded
+                    await self._save()
+
+                async for chunk in self._read(response, start):
+                    await writer.write(chunk)
+                    self.downloaded += len(chunk)
+                    await self._report()
+            finally:
+                # Leaves the file at the size of what was actually written
+                await writer.close(truncate=True)
+                self.checkpoint["offset"] = self.writers.pop(0).position
+
+            await self._report(force=True)
+
+    async def segment(self, client: httpx.AsyncClient, index: int):
+        # ranges[index] is [position, end), position moves as bytes arrive
+        segment = self.ranges[index]
+        headers = {
+            "Range": f"bytes={segment[0]}-{segment[1] - 1}",
+            **self._validator(),
+        }
+        sent = time.monotonic()
+        async with client.stream("GET", self.url, headers=headers) as response:
+            self.selector.record(self.url, latency=time.monotonic() - sent)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise DownloadError("The remote file changed")
+            self.check_size(content_range_total(response))
+            writer = self.writers[index] = FileWriter(
+                self.filename, segment[0], self.executor
+            )
+            received = 0
             try:
-                start = (
-                    os.path.getsize(filename)
-                    if os.path.exists(filename)
-                    else 0
+                async for chunk in self._read(response, segment[0]):
+                    await writer.write(chunk)
+                    received += len(chunk)
+                    self.downloaded += len(chunk)
+                    await self._report()
+            finally:
+                try:
+                    await writer.close()
+                finally:
+                    # Only what reached the disk counts on a retry
+                    self.downloaded -= received - (
+                        writer.position - segment[0]
+                    )
+                    segment[0] = self.writers.pop(index).position
+
+        if segment[0] < segment[1]:
+            raise Exception("Segment ended early")
+
+    async def attempt(self, client: httpx.AsyncClient):
+        started, downloaded = time.monotonic(), self.downloaded
+
+        start = 0 if self.ranges else self._resume_position()
+        if start and start == self.checkpoint.get("size"):
+            # Only the verification was missing
+            return self.verify()
+
+        if self.ranges is None and self.segments > 1 and start == 0:
+            await self.probe(client)
+
+        if self.ranges:
+            await gather_or_cancel(
+                *(
+                    self.segment(client, index)
+                    for index, (position, end) in enumerate(self.ranges)
+                    if position < end
                 )
-                await download(client, start)
-                break
-            except Exception as e:
-                if n == retry:
-                    raise e
+            )
+            await self._report(force=True)
+        else:
+            await self.stream(client, start)
+
+        elapsed = time.monotonic() - started
+        if elapsed > 0:
+            self.selector.record(
+                self.url, throughput=(self.downloaded - downloaded) / elapsed
+            )
+
+        self.verify()
+
+    async def run(self):
+        policy = self.policy
+        self.executor = ThreadPoolExecutor(
+            1, thread_name_prefix="download-writer"
+        )
+        _downloading.add(os.path.abspath(self.filename))
+        try:
+            for n in range(policy.retries + 1):
+                try:
+                    client = get_client(self.proxy)
+                    if self.refresh_url and policy.expired(self.url):
+                        await self._refresh(client)
+                    elif n == 0 and len(self.candidates) > 1:
+                        await self._use(self.candidates, client)
+
+                    await self.attempt(client)
+                    break
+                except Exception as e:
+                    action = policy.classify(e)
+                    if action == policy.RETRY:
+                        self.selector.record(self.url, failed=True)
+
+                    if action == policy.RESET:
+                        self.reset()
 
-                await asyncio.sleep(3)
+                    if n == policy.retries or action == policy.FAIL:
+                        raise e
+
+                    logging.debug(
+                        "Download of %s failed (%s), attempt %d: %s",
+                        self.filename,
+                        action,
+                        n + 1,
+                        e,
+                    )
+                    if action == policy.REFRESH:
+                        if not self.refresh_url:
+                            raise e
+
+                        # A freshly signed URL needs no backoff
+                        await self._refresh(client)
+                        continue
+
+                    if action == policy.RETRY and len(self.candidates) > 1:
+                        # Fail over to the next best host, the failed one
+                        # is penalised. Only back off once every host was
+                        # tried.
+                        await self._use(self.candidates, None)
+                        if n + 1 < len(self.candidates):
+                            continue
+
+                    await asyncio.sleep(policy.delay(n, e))
+        finally:
+            self.executor.shutdown(wait=False)
+            _downloading.discard(os.path.abspath(self.filename))
+
+        if os.path.exists(self.filename + CHECKPOINT_SUFFIX):
+            os.remove(self.filename + CHECKPOINT_SUFFIX)
+
+
+async def download_file(url: str | list[str], filename: str, **kwargs):
+    await Download(url, filename, **kwargs).run()
 
 
 async def download_progress(
@@ -196,79 +1267,426 @@ class DefaultDictMissing(dict):
         return self.missing_text.format(key=key)
 
 
-def parse_data(text: str, data: dict, missing_text: str = None):
-    _data = copy.deepcopy(data)
-    if "performer" in data:
-        _data["artist"] = data["performer"]["name"]
-    elif "artist" in data:
-        _data["artist"] = data["artist"]["name"]
+MISSING = object()
+
+
+def format_version(version: str) -> str:
+    return version if "(" in version else f"({version})"
+
+
+def full_name(title: str, version: str = None) -> str:
+    if not version:
+        return title
+
+    return f"{title} {format_version(version)}"
+
+
+@dataclass(slots=True)
+class Album:
+    id: str
+    title: str
+    version: str = None
+    artist: str = ""
+    main_artist: str = ""
+    genre: str = ""
+    tracks_count: int = 0
+    media_count: int | str = ""
+    date: str = ""
+    copyright: str = None
+    cover: str = None
+    duration: int = 0
+    tracks: list["Track"] = field(default_factory=list)
+    source: str = None
+    raw: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def name(self) -> str:
+        return full_name(self.title, self.version)
+
+    @property
+    def album_artist(self) -> str:
+        return self.main_artist or self.artist
+
+    @property
+    def total_tracks(self) -> int:
+        return self.tracks_count
+
+    @property
+    def total_discs(self) -> int | str:
+        return self.media_count
+
+    @property
+    def release_date(self) -> str:
+        return self.date
+
+    @property
+    def time(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=int(self.duration))
+
+
+@dataclass(slots=True)
+class Track:
+    id: str
+    title: str
+    version: str = None
+    artist: str = ""
+    duration: int = 0
+    track_number: int | str = ""
+    disc_number: int | str = ""
+    composer: str = ""
+    copyright: str = None
+    isrc: str = None
+    release_date: str = None
+    preview: str = None
+    format: str = ""
+    quality: str = ""
+    file_size: int = None
+    album_id: str = None
+    album: Album = None
+    lyrics: dict = None
+    source: str = None
+    raw: dict = field(default_factory=dict, repr=False)
+    # The file URL payload, bit_depth, sampling_rate and so on
+    stream: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def name(self) -> str:
+        return full_name(self.title, self.version)
+
+    @property
+    def time(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=int(self.duration))
+
+    @property
+    def date(self) -> str:
+        return self.release_date or (self.album.date if self.album else "")
+
+    @property
+    def genre(self) -> str:
+        return self.album.genre if self.album else ""
+
+    @property
+    def album_name(self) -> str:
+        return self.album.name if self.album else ""
+
+    album_title = album_name
+
+    @property
+    def album_artist(self) -> str:
+        return self.album.album_artist if self.album else ""
+
+    @property
+    def total_tracks(self) -> int:
+        return self.album.tracks_count if self.album else ""
+
+    @property
+    def total_discs(self) -> int | str:
+        return self.album.media_count if self.album else ""
+
+
+def _artist(data: dict):
     if "artists" in data:
-        _data["artist"] = ", ".join(
-            artist["name"] for artist in data["artists"]
-        )
-    if "title" in data:
-        _data["name"] = data["title"]
-    if "version" in data and data["version"]:
-        if "(" not in data["version"]:
-            _data["version"] = f"({data['version']})"
-        _data["name"] += f" {_data['version']}"
-    if "format_id" in data:
-        _data["format"] = "flac" if _data["format_id"] in {6, 7, 27} else "mp3"
-    if "album" in data:
-        _data["album_title"] = data["album"]["title"]
-        _data["album_name"] = data["album"]["title"]
-        _data["album_artist"] = data["album"]["artist"]["name"]
-        _data["total_tracks"] = data["album"]["tracks_count"]
-        _data["total_discs"] = data["album"]["media_count"]
-    if "release_date_original" in data:
-        _data["date"] = data["release_date_original"]
+        return ", ".join(artist["name"] for artist in data["artists"])
+    if "performer" in data:
+        return data["performer"]["name"]
+    if "artist" in data:
+        return data["artist"]["name"]
+
+    return MISSING
+
+
+def _version(data: dict):
+    version = data.get("version")
+    if not version:
+        return MISSING
+
+    return format_version(version)
+
+
+def _name(data: dict):
+    name = data["title"] if "title" in data else data.get("name", MISSING)
+    version = _version(data)
+    if name is MISSING or version is MISSING:
+        return name
+
+    return f"{name} {version}"
+
+
+def _format(data: dict):
+    if "format_id" not in data:
+        return MISSING
+
+    return "flac" if data["format_id"] in {6, 7, 27} else "mp3"
+
+
+def _album(key: str, *path: str):
+    def get(data: dict):
+        if "album" not in data:
+            return data.get(key, MISSING)
+
+        value = data["album"]
+        for item in path:
+            value = value[item]
+
+        return value
+
+    return get
+
+
+def _genre(data: dict):
     if "genre" in data.get("album", {}):
-        _data["genre"] = data["album"]["genre"]["name"]
-    if "composer" in data:
-        _data["composer"] = data["composer"]["name"]
-    if "media_number" in data:
-        _data["disc_number"] = data["media_number"]
-    _data["time"] = datetime.timedelta(seconds=int(data["duration"]))
-
-    return text.format_map(
-        DefaultDictMissing(_data, missing_text=missing_text)
-    )
+        return data["album"]["genre"]["name"]
+
+    return data.get("genre", MISSING)
+
+
+def _time(data: dict):
+    if "duration" not in data:
+        return data.get("time", MISSING)
+
+    return datetime.timedelta(seconds=int(data["duration"]))
+
 
+class TemplateData:
+    """Read-only view over a Track, an Album or a raw dict.
+
+    Derived fields such as artist, name or album_name are computed on
+    access from the source, which is never copied or modified. Fields a
+    model doesn't define are looked up in its raw payload, then in the
+    stream data of a Track.
+    """
+
+    __slots__ = ("data",)
+
+    derived = {
+        "artist": _artist,
+        "name": _name,
+        "version": _version,
+        "format": _format,
+        "album_title": _album("album_title", "title"),
+        "album_name": _album("album_name", "title"),
+        "album_artist": _album("album_artist", "artist", "name"),
+        "total_tracks": _album("total_tracks", "tracks_count"),
+        "total_discs": _album("total_discs", "media_count"),
+        "date": lambda data: data.get("release_date_original", MISSING),
+        "genre": _genre,
+        "composer": lambda data: (
+            data["composer"]["name"] if "composer" in data else MISSING
+        ),
+        "disc_number": lambda data: data.get("media_number", MISSING),
+        "time": _time,
+    }
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def get(self, key: str, default=MISSING):
+        if isinstance(self.data, (Track, Album)):
+            value = getattr(self.data, key, MISSING)
+            if value is None:
+                return default
+            if key == "version" and value:
+                # Templates have always seen it in brackets
+                value = format_version(value)
+            if value is MISSING:
+                value = self.data.raw.get(key, MISSING)
+            if value is MISSING and isinstance(self.data, Track):
+                value = self.data.stream.get(key, MISSING)
+            if value is MISSING:
+                value = default
+            elif isinstance(value, (Track, Album)):
+                value = value.raw
+
+            return value
+
+        value = MISSING
+        if key in self.derived:
+            value = self.derived[key](self.data)
+        if value is MISSING:
+            value = self.data.get(key, default)
+
+        return value
+
+
+class Template:
+    """A format string parsed once, see compile_template."""
+
+    __slots__ = ("text", "fields")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.fields = tuple(dict.fromkeys(self._fields(text)))
+
+    @classmethod
+    def _fields(cls, text: str):
+        for _, key, spec, _ in string.Formatter().parse(text):
+            if key:
+                # "album[title]" and "album.title" both need "album"
+                yield re.split(r"[.\[]", key, maxsplit=1)[0]
+            if spec:
+                yield from cls._fields(spec)
+
+    def render(
+        self, data: Track | Album | dict, missing_text: str = None
+    ) -> str:
+        view = data if isinstance(data, TemplateData) else TemplateData(data)
+        values = DefaultDictMissing(missing_text=missing_text)
+        for key in self.fields:
+            value = view.get(key)
+            if value is not MISSING:
+                values[key] = value
+
+        return self.text.format_map(values)
+
+
+@functools.lru_cache(maxsize=512)
+def compile_template(text: str) -> Template:
+    return Template(text)
+
+
+def parse_data(
+    text: str, data: Track | Album | dict, missing_text: str = None
+):
+    return compile_template(text).render(data, missing_text)
+
+
+def tag_text(value) -> str:
+    return "" if value is None else str(value)
+
+
+def read_cover(image_path: str) -> bytes | None:
+    if not image_path or not os.path.exists(image_path):
+        return None
+
+    with open(image_path, "rb") as f:
+        return f.read()
+
+
+def resize_cover(
+    data: bytes,
+    max_size: int = COVER_MAX_SIZE,
+    max_bytes: int = COVER_MAX_BYTES,
+) -> bytes | None:
+    if not data:
+        return None
+
+    if Image is None:
+        return data if len(data) <= max_bytes else None
+
+    image = Image.open(io.BytesIO(data))
+    if (
+        image.format == "JPEG"
+        and max(image.size) <= max_size
+        and len(data) <= max_bytes
+    ):
+        return data
+
+    image = image.convert("RGB")
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    while True:
+        for quality in (90, 80, 70):
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=quality, optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue()
+
+        if max(image.size) <= 100:
+            return None
+
+        image.thumbnail(
+            (image.width // 2, image.height // 2),
+            Image.Resampling.LANCZOS,
+        )
+
+
+class Cover:
+    """Album cover, read from disk once.
+
+    embed() returns a JPEG no larger than max_size pixels and max_bytes
+    bytes, the original file is left untouched.
+    """
+
+    __slots__ = ("path", "max_size", "max_bytes", "_data", "_embed")
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = None,
+        max_bytes: int = None,
+    ):
+        self.path = path
+        self.max_size = max_size or COVER_MAX_SIZE
+        self.max_bytes = max_bytes or COVER_MAX_BYTES
+        self._data = MISSING
+        self._embed = MISSING
+
+    @property
+    def data(self) -> bytes | None:
+        if self._data is MISSING:
+            self._data = read_cover(self.path)
+
+        return self._data
+
+    def embed(self) -> bytes | None:
+        if self._embed is MISSING:
+            try:
+                self._embed = resize_cover(
+                    self.data, self.max_size, self.max_bytes
+                )
+            except Exception:
+                logging.debug(traceback.format_exc())
+                self._embed = None
+
+        return self._embed
+
+
+def tag_padding(info: PaddingInfo) -> int:
+    # Keep whatever padding is left when the tags fit, so re-tagging
+    # only rewrites the metadata. Otherwise the file is rewritten once
+    # with enough room for later changes.
+    if info.padding >= 0:
+        return info.padding
+
+    return TAG_PADDING
+
+
+def tag_file(
+    file_path: str, image_path: str, track: Track, cover: bytes = None
+):
+    if cover is None:
+        cover = Cover(image_path).embed()
 
-def tag_file(file_path: str, image_path: str, track_info: dict):
     track_type = file_path.split(".")[-1].lower()
+    comment = (
+        "Downloaded by itisFarzin's bot."
+        f" Source: {track.source or 'Unknown'}."
+    )
     if track_type == "flac":
         tagger = FLAC(file_path)
 
-        picture = Picture()
-        picture.type = PictureType.COVER_FRONT
-        picture.mime = "image/jpeg"
-
-        with open(image_path, "rb") as f:
-            picture.data = f.read()
-
-        if len(picture.data) < 4 * 1024 * 1024:
+        if cover and len(cover) < 4 * 1024 * 1024:
+            picture = Picture()
+            picture.type = PictureType.COVER_FRONT
+            picture.mime = "image/jpeg"
+            picture.data = cover
+            tagger.clear_pictures()
             tagger.add_picture(picture)
 
-        tagger["title"] = parse_data("{name}", track_info)
-        tagger["artist"] = parse_data("{artist}", track_info)
-        tagger["album"] = parse_data("{album_name}", track_info)
-        tagger["albumartist"] = parse_data("{album_artist}", track_info)
-        tagger["tracknumber"] = parse_data("{track_number}", track_info)
-        tagger["totaltracks"] = parse_data("{total_tracks}", track_info)
-        tagger["discnumber"] = parse_data("{disc_number}", track_info)
-        tagger["totaldiscs"] = parse_data("{total_discs}", track_info)
-        tagger["date"] = parse_data("{date}", track_info, "")
-        tagger["genre"] = parse_data("{genre}", track_info, "")
-        tagger["composer"] = parse_data("{composer}", track_info)
-        tagger["copyright"] = parse_data("{copyright}", track_info)
-        tagger["comment"] = parse_data(
-            "Downloaded by itisFarzin's bot. Source: {source}.",
-            track_info,
-            "Unknown",
-        )
+        tagger["title"] = track.name
+        tagger["artist"] = track.artist
+        tagger["album"] = track.album_name
+        tagger["albumartist"] = track.album_artist
+        tagger["tracknumber"] = tag_text(track.track_number)
+        tagger["totaltracks"] = tag_text(track.total_tracks)
+        tagger["discnumber"] = tag_text(track.disc_number)
+        tagger["totaldiscs"] = tag_text(track.total_discs)
+        tagger["date"] = tag_text(track.date)
+        tagger["genre"] = tag_text(track.genre)
+        tagger["composer"] = tag_text(track.composer)
+        tagger["copyright"] = tag_text(track.copyright)
+        tagger["comment"] = comment
 
-        if lyrics := track_info.get("lyrics"):
+        if lyrics := track.lyrics:
             tagger["LYRICS"] = "\n".join(
                 map(
                     lambda lyrics: f"{lyrics[0]}{lyrics[1]}",
@@ -276,76 +1694,162 @@ def tag_file(file_path: str, image_path: str, track_info: dict):
                 )
             )
 
-        tagger.save(file_path)
+        tagger.save(padding=tag_padding)
     elif track_type == "mp3":
         tagger = MP3(file_path)
-        tagger.add_tags()
+        if tagger.tags is None:
+            tagger.add_tags()
 
-        with open(image_path, "rb") as f:
+        if cover:
             tagger.tags.add(
                 APIC(
                     encoding=3,
                     mime="image/jpeg",
                     type=3,
                     desc="Cover",
-                    data=f.read(),
+                    data=cover,
                 )
             )
 
-        tagger.tags["TIT2"] = TIT2(
-            encoding=3, text=[parse_data("{name}", track_info)]
-        )
-        tagger.tags["TPE1"] = TPE1(
-            encoding=3, text=[parse_data("{artist}", track_info)]
-        )
-        tagger.tags["TALB"] = TALB(
-            encoding=3, text=[parse_data("{album_name}", track_info)]
-        )
-        tagger.tags["TPE2"] = TPE2(
-            encoding=3, text=[parse_data("{album_artist}", track_info)]
-        )
+        tagger.tags["TIT2"] = TIT2(encoding=3, text=[track.name])
+        tagger.tags["TPE1"] = TPE1(encoding=3, text=[track.artist])
+        tagger.tags["TALB"] = TALB(encoding=3, text=[track.album_name])
+        tagger.tags["TPE2"] = TPE2(encoding=3, text=[track.album_artist])
         tagger.tags["TRCK"] = TRCK(
             encoding=3,
             text=[
-                parse_data("{track_number}", track_info)
+                tag_text(track.track_number)
                 + "/"
-                + parse_data("{total_tracks}", track_info)
+                + tag_text(track.total_tracks)
             ],
         )
         tagger.tags["TPOS"] = TPOS(
             encoding=3,
             text=[
-                parse_data("{disc_number}", track_info)
-                + "/"
-                + parse_data("{total_discs}", track_info)
+                tag_text(track.disc_number) + "/" + tag_text(track.total_discs)
             ],
         )
-        tagger.tags["TDRC"] = TDRC(
-            encoding=3, text=[parse_data("{date}", track_info, "")]
-        )
-        tagger.tags["TCON"] = TCON(
-            encoding=3, text=[parse_data("{genre}", track_info, "")]
-        )
-        tagger.tags["TCOM"] = TCOM(
-            encoding=3, text=[parse_data("{composer}", track_info)]
-        )
+        tagger.tags["TDRC"] = TDRC(encoding=3, text=[tag_text(track.date)])
+        tagger.tags["TCON"] = TCON(encoding=3, text=[tag_text(track.genre)])
+        tagger.tags["TCOM"] = TCOM(encoding=3, text=[tag_text(track.composer)])
         tagger.tags["TCOP"] = TCOP(
-            encoding=3, text=[parse_data("{copyright}", track_info)]
+            encoding=3, text=[tag_text(track.copyright)]
         )
         tagger.tags["COMM"] = COMM(
-            encoding=3,
-            lang="eng",
-            desc="Comment",
-            text=[
-                parse_data(
-                    "Downloaded by itisFarzin's bot. Source: {source}.",
-                    track_info,
-                    "Unknown",
-                )
-            ],
+            encoding=3, lang="eng", desc="Comment", text=[comment]
         )
 
-        tagger.save()
+        tagger.save(padding=tag_padding)
+
+
+def get_tag_executor(workers: int = None, processes: bool = False):
+    key = (max(1, workers or TAG_WORKERS), processes)
+    executor = _tag_executors.get(key)
+    if executor is None:
+        if processes:
+            executor = ProcessPoolExecutor(key[0])
+        else:
+            executor = ThreadPoolExecutor(key[0], "tagger")
+        _tag_executors[key] = executor
+
+    return executor
+
+
+def tag_executor_settings(settings) -> tuple[int, bool]:
+    return (
+        int(settings.getdata("tag_workers", 0) or 0),
+        settings.getdata("tag_processes").is_enabled,
+    )
+
+
+def close_tag_executors(wait: bool = False, keep: Executor = None):
+    # Executors other than keep were replaced by a new configuration,
+    # they still finish the files they were given
+    for key, executor in list(_tag_executors.items()):
+        if executor is keep:
+            continue
+
+        del _tag_executors[key]
+        executor.shutdown(wait=wait, cancel_futures=not wait and not keep)
+
+
+@dataclass(slots=True)
+class TagResult:
+    file_path: str
+    track: Track
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class TagBatch:
+    """Tags the tracks of one album in an executor.
+
+    Files are submitted with add() as soon as they are downloaded and
+    tagged in the background, the cover is read from disk once per
+    batch and downscaled for embedding. wait() returns a TagResult for
+    every submitted file.
+    """
+
+    def __init__(
+        self,
+        image_path: str = None,
+        executor: Executor = None,
+        cover_size: int = None,
+        cover_bytes: int = None,
+    ):
+        self.image_path = image_path
+        self.executor = executor or get_tag_executor()
+        self.tasks: list[asyncio.Task] = []
+        self.cover = Cover(image_path, cover_size, cover_bytes)
+        self._embed: asyncio.Future | None = None
+
+    @classmethod
+    def from_settings(cls, image_path: str, settings) -> "TagBatch":
+        return cls(
+            image_path,
+            get_tag_executor(*tag_executor_settings(settings)),
+            int(settings.getdata("cover_max_size", 0) or 0),
+            int(settings.getdata("cover_max_bytes", 0) or 0),
+        )
+
+    async def embed_cover(self) -> bytes | None:
+        if self._embed is None:
+            self._embed = asyncio.get_running_loop().run_in_executor(
+                None, self.cover.embed
+            )
+
+        return await self._embed
+
+    async def _tag(self, file_path: str, track: Track) -> TagResult:
+        result = TagResult(file_path, track)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                tag_file,
+                file_path,
+                self.image_path,
+                track,
+                await self.embed_cover() or b"",
+            )
+        except Exception as e:
+            logging.debug(traceback.format_exc())
+            result.error = e
+
+        return result
+
+    def add(self, file_path: str, track: Track) -> asyncio.Task:
+        task = asyncio.create_task(self._tag(file_path, track))
+        self.tasks.append(task)
+
+        return task
+
+    async def wait(self) -> list[TagResult]:
+        tasks, self.tasks = self.tasks, []
+
+        return list(await asyncio.gather(*tasks))
 
 
 __util__ = True
@@ -0,0 +1,111 @@
+"""Throughput of the Deezer BF_CBC_STRIPE decryption.
+
+Compares the previous per-block decryption with decrypt_stripes, on a
+single track and on several tracks decrypted at once through the
+thread and the process pool. Only cryptography has to be installed,
+the bot is not needed:
+
+    python scripts/bench_deezer_decrypt.py [size in MiB] [tracks]
+
+The thread pool holds the GIL for part of every batch, the process
+pool only pulls ahead on a machine with more than one core.
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.decrepit.ciphers import algorithms  # noqa: E402
+from cryptography.hazmat.primitives.ciphers import Cipher, modes  # noqa: E402
+from music.stripes import (  # noqa: E402
+    BLOCK_SIZE,
+    STRIPE_IV,
+    decrypt_stripes,
+    get_decrypt_executor,
+)
+
+# Matches TRANSFORM_BATCH_SIZE in music/util.py
+BATCH_SIZE = 256 * 1024
+
+
+def decrypt_blocks(key: bytes, index: int, data: bytes) -> bytes:
+    # The implementation decrypt_stripes replaced, one Cipher per block
+    result = bytearray(data)
+    for start in range(0, len(data) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        if (index + start // BLOCK_SIZE) % 3:
+            continue
+
+        end = start + BLOCK_SIZE
+        decryptor = Cipher(
+            algorithms.Blowfish(key),
+            modes.CBC(STRIPE_IV),
+            backend=default_backend(),
+        ).decryptor()
+        result[start:end] = (
+            decryptor.update(data[start:end]) + decryptor.finalize()
+        )
+
+    return bytes(result)
+
+
+def batches(data: bytes):
+    for start in range(0, len(data), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        yield start // BLOCK_SIZE, data[start:end]
+
+
+def run(func, key: bytes, data: bytes) -> tuple[float, bytes]:
+    start = time.perf_counter()
+    result = b"".join(
+        func(key, index, chunk) for index, chunk in batches(data)
+    )
+
+    return time.perf_counter() - start, result
+
+
+async def run_concurrent(
+    key: bytes, data: bytes, tracks: int, processes: bool
+) -> float:
+    loop = asyncio.get_running_loop()
+    executor = get_decrypt_executor(processes)
+
+    async def track():
+        # Each track waits for its batches in order, like a download
+        for index, chunk in batches(data):
+            await loop.run_in_executor(
+                executor, decrypt_stripes, key, index, chunk
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(track() for _ in range(tracks)))
+
+    return time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    key = os.urandom(16)
+    data = os.urandom(size * 1024 * 1024)
+
+    old_time, old = run(decrypt_blocks, key, data)
+    new_time, new = run(decrypt_stripes, key, data)
+    if old != new:
+        raise SystemExit("decrypt_stripes output differs from the baseline")
+
+    print(f"per-block Cipher: {size / old_time:8.1f} MiB/s")
+    print(f"decrypt_stripes:  {size / new_time:8.1f} MiB/s")
+    print(f"speedup:          {old_time / new_time:8.1f}x")
+
+    print(f"{os.cpu_count()} cores, {tracks} tracks at once:")
+    for name, processes in (("thread pool", False), ("process pool", True)):
+        pool_time = asyncio.run(run_concurrent(key, data, tracks, processes))
+        print(f"{name + ':':17} {size * tracks / pool_time:8.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()